@@ -0,0 +1,251 @@
+import argparse
+import datetime
+import os
+import random
+import struct
+
+
+###############################################################################################################
+# Generates a synthetic iPhone dump for benchmarks and for safely trying out the moving modes.
+# All files are tiny but valid: JPEGs (8x8 pixel blocks) carry an Exif block with DateTimeOriginal and a
+# thumbnail, MOVs carry the mvhd and Apple creation date atoms. The mix of file types roughly follows a real
+# dump: plain photos, live-photo pairs, edited IMG_E versions with AAE sidecars, WhatsApp images without Exif,
+# screenshots, videos, and some duplicates (copies in subfolders and leftovers of safe moving with __NNN).
+# Like the camera, the numbering continues in DCIM style subfolders (100APPLE, 101APPLE, ...) after IMG_9999.
+# Existing files are never overwritten, so the generated paths are exactly the new files on disk.
+class LibraryGenerator(object):
+
+    # share of the generated "shots" per kind, each shot produces one or more files
+    shot_kinds = [("photo", 0.45), ("live", 0.15), ("edited", 0.10), ("whatsapp", 0.12),
+                  ("screenshot", 0.05), ("video", 0.05), ("duplicate", 0.08)]
+
+    first_date = datetime.datetime(2015, 1, 1)
+    last_date = datetime.datetime(2024, 12, 31)
+
+    def __init__(self, seed=0, duplicates=True):
+        self.random = random.Random(seed)
+        self.duplicates = duplicates   # False gives a tree without equal file names (as long as IMG_9999 is not passed)
+        self.img_number = 0
+        self.img_folder = None         # subfolder of the current IMG_ numbers, None for the library folder itself
+        self.wa_number = 0
+        self.generated = []   # paths of the generated files
+        self.num_bytes = 0
+
+    def generate(self, folder_path, num_files):
+        os.makedirs(folder_path, exist_ok=True)
+        shot_kinds = [(kind, weight) for kind, weight in self.shot_kinds if self.duplicates or kind != "duplicate"]
+        kinds = [kind for kind, _ in shot_kinds]
+        weights = [weight for _, weight in shot_kinds]
+        while len(self.generated) < num_files:
+            kind = self.random.choices(kinds, weights)[0]
+            if kind == "duplicate" and not self.generated:
+                continue
+            getattr(self, "add" + kind.capitalize())(folder_path)
+        return self.generated
+
+    ###############################################################################################################
+    # shots
+    def addPhoto(self, folder_path):
+        (img_path, number), dt = self.nextImgNumber(folder_path), self.randomDate()
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.JPG"), self.makeJpeg(self.randomPattern(), dt))
+
+    def addLive(self, folder_path):
+        (img_path, number), dt = self.nextImgNumber(folder_path), self.randomDate()
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.JPG"), self.makeJpeg(self.randomPattern(), dt))
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.MOV"), self.makeMov(dt + datetime.timedelta(seconds=1)))
+
+    def addEdited(self, folder_path):
+        (img_path, number), dt = self.nextImgNumber(folder_path), self.randomDate()
+        pattern = self.randomPattern()
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.JPG"), self.makeJpeg(pattern, dt))
+        self.writeFile(os.path.join(img_path, f"IMG_E{number:04}.JPG"), self.makeJpeg(self.varyPattern(pattern), dt))
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.AAE"), self.makeAae(dt))
+
+    def addWhatsapp(self, folder_path):
+        self.wa_number += 1
+        dt = self.randomDate()
+        name = f"IMG-{dt:%Y%m%d}-WA{self.wa_number % 10000:04}.jpg"
+        # WhatsApp removes the Exif data
+        self.writeFile(os.path.join(folder_path, name), self.makeJpeg(self.randomPattern(), None))
+
+    def addScreenshot(self, folder_path):
+        img_path, number = self.nextImgNumber(folder_path)
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.PNG"), self.makePng())
+
+    def addVideo(self, folder_path):
+        (img_path, number), dt = self.nextImgNumber(folder_path), self.randomDate()
+        self.writeFile(os.path.join(img_path, f"IMG_{number:04}.MOV"), self.makeMov(dt))
+
+    def addDuplicate(self, folder_path):
+        original = self.random.choice(self.generated)
+        with open(original, 'rb') as f:
+            content = f.read()
+        stem, ext = os.path.splitext(os.path.basename(original))
+        if self.random.random() < 0.5:
+            # copy of an earlier import in a subfolder
+            subfolder = os.path.join(folder_path, f"Import_{self.random.randint(1, 5)}")
+            os.makedirs(subfolder, exist_ok=True)
+            target = os.path.join(subfolder, os.path.basename(original))
+        else:
+            # leftover of a previous safe move
+            target = os.path.join(os.path.dirname(original), f"{stem}__{self.random.randint(1, 3):03}{ext}")
+        self.writeFile(target, content)
+
+    ###############################################################################################################
+    # helpers
+    # (folder, number) of the next IMG_ file, after IMG_9999 the numbering starts again in the next DCIM folder
+    def nextImgNumber(self, folder_path):
+        if self.img_number == 9999:
+            self.img_number = 0
+            self.img_folder = 100 if self.img_folder is None else self.img_folder + 1
+        self.img_number += 1
+        if self.img_folder is None:
+            return folder_path, self.img_number
+        img_path = os.path.join(folder_path, f"{self.img_folder}APPLE")
+        os.makedirs(img_path, exist_ok=True)
+        return img_path, self.img_number
+
+    def randomDate(self):
+        span = int((self.last_date - self.first_date).total_seconds())
+        return self.first_date + datetime.timedelta(seconds=self.random.randrange(span))
+
+    # 4x4 blocks of gray values
+    def randomPattern(self):
+        return [self.random.randrange(16, 240) for _ in range(16)]
+
+    def varyPattern(self, pattern):
+        return [min(255, max(0, value + self.random.randint(-6, 6))) for value in pattern]
+
+    # skips files that exist already (e.g. a WhatsApp name taken again after WA9999)
+    def writeFile(self, file_path, content):
+        try:
+            with open(file_path, 'xb') as f:
+                f.write(content)
+        except FileExistsError:
+            return
+        self.generated.append(file_path)
+        self.num_bytes += len(content)
+
+    ###############################################################################################################
+    # file formats
+    @classmethod
+    def makeJpeg(cls, pattern, dt):
+        image = cls.encodeGrayJpeg(pattern)
+        if dt is None:
+            return image
+        # the thumbnail is the same (already tiny) image
+        exif = b'Exif\x00\x00' + cls.makeTiff(dt, image)
+        return image[:2] + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + image[2:]
+
+    # baseline JPEG of 4x4 flat 8x8 blocks, grayscale, quantization 1, minimal Huffman tables
+    @staticmethod
+    def encodeGrayJpeg(pattern):
+        dqt = b'\xff\xdb\x00\x43\x00' + b'\x01' * 64
+        sof = b'\xff\xc0\x00\x0b\x08\x00\x20\x00\x20\x01\x01\x11\x00'
+        # DC: categories 0..11 with 4 bit codes 0000..1011, AC: only EOB with code 0
+        dht_dc = b'\xff\xc4\x00\x1f\x00' + bytes([0, 0, 0, 12] + [0] * 12) + bytes(range(12))
+        dht_ac = b'\xff\xc4\x00\x14\x10' + bytes([1] + [0] * 15) + b'\x00'
+        sos = b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00'
+
+        bits = []
+        previous_dc = 0
+        for value in pattern:
+            dc = (value - 128) * 8
+            diff = dc - previous_dc
+            previous_dc = dc
+            category = abs(diff).bit_length()
+            bits += [int(b) for b in format(category, '04b')]
+            if category:
+                extra = diff if diff >= 0 else diff + (1 << category) - 1
+                bits += [int(b) for b in format(extra, f'0{category}b')]
+            bits.append(0)  # EOB
+        bits += [1] * (-len(bits) % 8)
+        data = bytearray()
+        for i in range(0, len(bits), 8):
+            byte = int(''.join(map(str, bits[i:i + 8])), 2)
+            data.append(byte)
+            if byte == 0xFF:
+                data.append(0)
+        return b'\xff\xd8' + dqt + sof + dht_dc + dht_ac + sos + bytes(data) + b'\xff\xd9'
+
+    # little-endian TIFF structure with IFD0 (Make, Exif pointer), Exif IFD (dates) and IFD1 (thumbnail)
+    @staticmethod
+    def makeTiff(dt, thumbnail):
+        make = b'Apple\x00'
+        date = dt.strftime("%Y:%m:%d %H:%M:%S").encode() + b'\x00'
+        offset = b'+01:00\x00'
+        ifd0_offset = 8
+        ifd0_size = 2 + 2 * 12 + 4
+        exif_offset = ifd0_offset + ifd0_size
+        exif_size = 2 + 2 * 12 + 4
+        ifd1_offset = exif_offset + exif_size
+        ifd1_size = 2 + 3 * 12 + 4
+        data_offset = ifd1_offset + ifd1_size
+        make_offset, date_offset = data_offset, data_offset + len(make)
+        offset_offset = date_offset + len(date)
+        thumbnail_offset = offset_offset + len(offset)
+
+        entry = lambda tag, value_type, count, value: struct.pack('<HHII', tag, value_type, count, value)
+        tiff = b'II' + struct.pack('<HI', 42, ifd0_offset)
+        tiff += struct.pack('<H', 2) + entry(0x010F, 2, len(make), make_offset) + entry(0x8769, 4, 1, exif_offset)
+        tiff += struct.pack('<I', ifd1_offset)
+        tiff += struct.pack('<H', 2) + entry(0x9003, 2, len(date), date_offset) + entry(0x9011, 2, len(offset), offset_offset)
+        tiff += struct.pack('<I', 0)
+        tiff += struct.pack('<H', 3) + entry(0x0103, 3, 1, 6) + entry(0x0201, 4, 1, thumbnail_offset) \
+                + entry(0x0202, 4, 1, len(thumbnail))
+        tiff += struct.pack('<I', 0)
+        return tiff + make + date + offset + thumbnail
+
+    # QuickTime movie with a bit of media data, mvhd (UTC) and Apple's creation date key (local time)
+    @staticmethod
+    def makeMov(dt):
+        box = lambda box_type, payload: struct.pack('>I4s', 8 + len(payload), box_type) + payload
+        seconds = int((dt - datetime.timedelta(hours=1) - datetime.datetime(1904, 1, 1)).total_seconds())
+        mvhd = box(b'mvhd', b'\x00' * 4 + struct.pack('>IIII', seconds, seconds, 600, 600) + b'\x00' * 80)
+        key = b'com.apple.quicktime.creationdate'
+        keys = box(b'keys', b'\x00' * 4 + struct.pack('>I', 1) + struct.pack('>I4s', 8 + len(key), b'mdta') + key)
+        value = dt.strftime("%Y-%m-%dT%H:%M:%S+0100").encode()
+        ilst = box(b'ilst', box(struct.pack('>I', 1), box(b'data', struct.pack('>II', 1, 0) + value)))
+        meta = box(b'meta', box(b'hdlr', b'\x00' * 8 + b'mdta' + b'\x00' * 12) + keys + ilst)
+        ftyp = box(b'ftyp', b'qt  \x00\x00\x00\x00qt  ')
+        mdat = box(b'mdat', b'\x00' * 512)
+        return ftyp + b'\x00\x00\x00\x08wide' + mdat + box(b'moov', mvhd + meta)
+
+    @staticmethod
+    def makeAae(dt):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<plist version="1.0"><dict>'
+                '<key>adjustmentFormatIdentifier</key><string>com.apple.photo</string>'
+                f'<key>adjustmentTimestamp</key><date>{dt:%Y-%m-%dT%H:%M:%SZ}</date>'
+                '</dict></plist>\n').encode()
+
+    # 1x1 gray PNG without metadata
+    @staticmethod
+    def makePng():
+        import zlib
+        chunk = lambda chunk_type, data: struct.pack('>I', len(data)) + chunk_type + data + \
+                                         struct.pack('>I', zlib.crc32(chunk_type + data))
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + \
+               chunk(b'IDAT', zlib.compress(b'\x00\x80')) + chunk(b'IEND', b'')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic iPhone picture dump')
+    parser.add_argument('--path', dest='path', required=True, type=str,
+                       help='folder to create the files in (created if missing).')
+    parser.add_argument('--files', dest='files', required=False, type=int, default=10000,
+                       help='number of files to generate. Default: 10000')
+    parser.add_argument('--seed', dest='seed', required=False, type=int, default=0,
+                       help='seed of the random generator, equal seeds give equal libraries. Default: 0')
+    parser.add_argument('--no_duplicates', dest='no_duplicates', required=False, action='store_true',
+                       help='If true, no duplicates are generated, so that all file names are unique (up to 9999 '
+                            'IMG_ numbers) and mode 4 can move everything back.')
+    args = parser.parse_args()
+
+    generator = LibraryGenerator(args.seed, duplicates=not args.no_duplicates)
+    files = generator.generate(args.path, args.files)
+    print(f"Generated {len(files)} files ({generator.num_bytes} bytes) in {args.path}")
+
+
+if __name__ == '__main__':
+    main()
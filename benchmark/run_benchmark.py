@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_library import LibraryGenerator
+
+
+###############################################################################################################
+# Times every mode of picture_magic.py on a synthetic library. Each run gets a fresh (hard linked) copy of the
+# generated library, so moving modes always start from the same tree and the template is generated only once.
+# Next to the wall time each run reports the read/write syscalls (Linux only) and the peak RSS of the
+# process and of its children (exiftool). The results are written as JSON and can be compared between versions.
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "picture_magic.py")
+
+# modes that need another mode to prepare the tree, the setup run is not timed
+setup_modes = {4: [3], 8: [3]}
+# extra arguments per mode, mode 2 would ask for deletions otherwise
+mode_args = {2: ["--dry_run"]}
+# modes that refuse to work if file names clash, they get a library without duplicates. If they still give up
+# (their output contains the message), only the early exit was timed and the result is marked invalid.
+clash_free_modes = {4: "Cannot move back"}
+
+# runs picture_magic.py in the child process and dumps the resource usage when it exits
+bootstrap = """
+import atexit, json, resource, runpy, sys
+def dumpUsage(usage_path=sys.argv.pop(1)):
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            io = dict((key, int(value)) for key, value in (line.split(':') for line in f))
+    except OSError:
+        pass
+    usage = {'maxrss_self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             'maxrss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+             'read_syscalls': io.get('syscr'), 'write_syscalls': io.get('syscw')}
+    with open(usage_path, 'w') as f:
+        json.dump(usage, f)
+atexit.register(dumpUsage)
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def copyLibrary(template_path, target_path):
+    try:
+        shutil.copytree(template_path, target_path, copy_function=os.link)
+    except OSError:
+        shutil.rmtree(target_path, ignore_errors=True)
+        shutil.copytree(template_path, target_path)
+
+
+def runPictureMagic(mode, library_path, extra_args, usage_path=None):
+    command = [sys.executable]
+    if usage_path:
+        command += ["-c", bootstrap, usage_path]
+    command += [script_path, "--mode", str(mode), "--path", library_path] + mode_args.get(mode, []) + extra_args
+    start = time.perf_counter()
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    duration = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Mode {mode} failed: {result.stderr.decode(errors='replace')}")
+    return duration, result.stdout.decode(errors='replace')
+
+
+def generateLibrary(template_path, num_files, seed, duplicates=True):
+    start = time.perf_counter()
+    generator = LibraryGenerator(seed, duplicates)
+    num_files = len(generator.generate(template_path, num_files))
+    print(f"Generated {num_files} files ({generator.num_bytes} bytes) in {time.perf_counter() - start:.1f}s")
+    return num_files
+
+
+def benchmarkMode(mode, template_path, work_path, num_files, extra_args):
+    library_path = os.path.join(work_path, f"mode_{mode}")
+    usage_path = os.path.join(work_path, f"mode_{mode}.json")
+    copyLibrary(template_path, library_path)
+    try:
+        for setup_mode in setup_modes.get(mode, []):
+            runPictureMagic(setup_mode, library_path, extra_args)
+        duration, output = runPictureMagic(mode, library_path, extra_args, usage_path)
+        with open(usage_path) as f:
+            usage = json.load(f)
+    finally:
+        shutil.rmtree(library_path, ignore_errors=True)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    rss_unit = 1 if platform.system() == "Darwin" else 1024
+    valid = mode not in clash_free_modes or clash_free_modes[mode] not in output
+    return {"valid": valid,
+            "files": num_files,
+            "wall_s": round(duration, 3),
+            "files_per_s": round(num_files / duration, 1),
+            "read_syscalls": usage["read_syscalls"],
+            "write_syscalls": usage["write_syscalls"],
+            "peak_rss_mb": round(usage["maxrss_self"] * rss_unit / 2**20, 1),
+            "peak_rss_children_mb": round(usage["maxrss_children"] * rss_unit / 2**20, 1)}
+
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(script_path),
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def printResults(results):
+    print(f"{'mode':>4} {'wall_s':>9} {'files/s':>10} {'reads':>10} {'writes':>10} {'rss_mb':>8} {'child_mb':>8}")
+    for mode, result in results["modes"].items():
+        print(f"{mode:>4} {result['wall_s']:>9} {result['files_per_s']:>10} {str(result['read_syscalls']):>10} "
+              f"{str(result['write_syscalls']):>10} {result['peak_rss_mb']:>8} {result['peak_rss_children_mb']:>8}"
+              + ("" if result.get("valid", True) else "  INVALID: gave up early"))
+
+
+def printComparison(old_results, results):
+    print(f"Compared to {old_results.get('version')} (new / old):")
+    keys = ["wall_s", "read_syscalls", "write_syscalls", "peak_rss_mb"]
+    print(f"{'mode':>4} " + " ".join(f"{key:>15}" for key in keys))
+    for mode, result in results["modes"].items():
+        old_result = old_results["modes"].get(mode)
+        if old_result is None or not result.get("valid", True) or not old_result.get("valid", True):
+            continue
+        ratios = []
+        for key in keys:
+            if result[key] is None or not old_result.get(key):
+                ratios.append(f"{'-':>15}")
+            else:
+                ratios.append(f"{result[key] / old_result[key]:>15.2f}")
+        print(f"{mode:>4} " + " ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the modes of picture_magic.py on a synthetic library')
+    parser.add_argument('--files', dest='files', required=False, type=int, default=10000,
+                       help='number of files in the synthetic library. Default: 10000')
+    parser.add_argument('--seed', dest='seed', required=False, type=int, default=0,
+                       help='seed of the library generator. Default: 0')
+    parser.add_argument('--modes', dest='modes', required=False, type=str, default="0,1,2,3,4,5,6,7,8",
+                       help='comma separated modes to benchmark. Default: 0,1,2,3,4,5,6,7,8')
+    parser.add_argument('--workers', dest='workers', required=False, type=int, default=1,
+                       help='value of --workers passed to picture_magic.py. Default: 1')
+    parser.add_argument('--no_cache', dest='no_cache', required=False, action='store_true',
+                       help='pass --no_cache to picture_magic.py.')
+    parser.add_argument('--work_dir', dest='work_dir', required=False, type=str, default=None,
+                       help='folder for the library and its copies, should be on the file system you want to '
+                            'measure. Default: a temporary folder')
+    parser.add_argument('--output', dest='output', required=False, type=str, default=None,
+                       help='write the results as JSON to this file.')
+    parser.add_argument('--compare', dest='compare', required=False, type=str, default=None,
+                       help='JSON file of an earlier run to compare the results with.')
+    args = parser.parse_args()
+
+    modes = [int(mode) for mode in args.modes.split(",")]
+    extra_args = ["--workers", str(args.workers)] + (["--no_cache"] if args.no_cache else [])
+    work_path = tempfile.mkdtemp(prefix="picture_magic_bench_", dir=args.work_dir)
+    try:
+        template_path = os.path.join(work_path, "template")
+        print(f"Generating {args.files} files in {template_path}")
+        num_files = generateLibrary(template_path, args.files, args.seed)
+        clash_free_path = os.path.join(work_path, "template_clash_free")
+        num_clash_free_files = None
+        if any(mode in clash_free_modes for mode in modes):
+            print(f"Generating {args.files} files without duplicates in {clash_free_path}")
+            num_clash_free_files = generateLibrary(clash_free_path, args.files, args.seed, duplicates=False)
+
+        results = {"version": gitVersion(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "files": num_files,
+                   "seed": args.seed,
+                   "workers": args.workers,
+                   "no_cache": args.no_cache,
+                   "modes": {}}
+        for mode in modes:
+            print(f"Running mode {mode}...")
+            if mode in clash_free_modes:
+                result = benchmarkMode(mode, clash_free_path, work_path, num_clash_free_files, extra_args)
+            else:
+                result = benchmarkMode(mode, template_path, work_path, num_files, extra_args)
+            results["modes"][str(mode)] = result
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    printResults(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            printComparison(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
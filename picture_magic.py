@@ -1,25 +1,23 @@
 import argparse
-from genericpath import isfile
 import os
+import io
 import shutil
 import re
 import collections
+import hashlib
+import json
+import sqlite3
+import struct
+import threading
+import contextlib
 
-from glob import glob
 from pathlib import Path
 import time
-from typing import Collection
-
-from exif import Image
-import exifread
-import exiftool
-import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import platform
-
-
-import pytz
 import datetime
-#import win32com
+# exifread, exiftool, pytz, win32com, Pillow and numpy are imported where they are needed, so that
+# the modes that do not read any metadata start fast and work without them
 
 
 class PictureMagic(object):
@@ -32,6 +30,66 @@ class PictureMagic(object):
     dirname_remaining = "Pics_and_Movies"
     special_folders = [dirname_aae, dirname_downloads, dirname_live_imgs, dirname_originals, dirname_remaining]
 
+    # hidden folder inside the given path that holds the state of this script (e.g. the metadata cache).
+    # It is skipped by all modes, so it is never counted, sorted or moved.
+    dirname_state = ".picture_magic"
+    # folder inside the given path that mode 11 moves deleted duplicates into (with --quarantine), also skipped
+    dirname_quarantine = "_Quarantine"
+    excluded_dirs = [dirname_state, dirname_quarantine]
+    # file of the deletion plan written by modes 2 and 10 with --keep_rules, in the state folder
+    filename_deletion_plan = "deletion_plan.txt"
+
+    # rules that choose the copy of a duplicate group that is kept (--keep_rules), checked in the given order
+    keep_rules = {'folder:NAME': 'keep a copy inside folder NAME (e.g. folder:Pics_and_Movies)',
+                  'shortest_path': 'keep the copy with the shortest path',
+                  'oldest': 'keep the copy with the oldest modification time',
+                  'newest': 'keep the copy with the newest modification time',
+                  'largest': 'keep the largest copy (for similar images)',
+                  'keep_outside:NAME': 'never delete the only copy outside folder NAME (e.g. keep_outside:_Originals)'}
+
+    # modes that move files, their moves are planned first and executed with a journal that mode 8 can undo
+    moving_modes = [3, 4, 5, 6, 7, 8, 9, 11]
+
+    # file types for which a capture timestamp is looked up (matched against the lower-case file name)
+    image_suffixes = ("jpg", "jpeg", "png", "heic")
+    video_suffixes = ("mov", "mp4")
+
+    # sources of the capture dates of mode 5 (--date_sources), from the cheapest to the most expensive one
+    date_sources = {'filename': 'date in the file name (e.g. IMG-20230512-WA0001.jpg, Screenshot 2023-05-12 at ...)',
+                    'twin': 'date of the live photo, edited version or AAE file with the same IMG_ number',
+                    'metadata': 'capture date from the Exif or QuickTime metadata',
+                    'mtime': 'modification time of the file'}
+    # date (and optional time) in a file name, e.g. 20230512_140322, 2023-05-12 at 14.03.22, IMG-20230512-WA0001
+    filename_date_pattern = re.compile(r"(?<!\d)((?:19|20)\d\d)[-_.]?(0[1-9]|1[0-2])[-_.]?(0[1-9]|[12]\d|3[01])(?!\d)"
+                                       r"(?:(?:[ _T-]|\s+at\s+)([01]\d|2[0-3])[-_.:]?([0-5]\d)[-_.:]?([0-5]\d)(?!\d))?")
+
+    # duplicate detection by content: bytes hashed at the start and at the end of a file before hashing it fully
+    partial_hash_size = 4096
+    full_hash_buffer_size = 1024 * 1024
+
+    # print a progress line every n files while scanning
+    progress_interval = 10000
+
+    # number of videos handed to exiftool per get_metadata() call
+    exiftool_batch_size = 200
+
+    def __init__(self):
+        # long-lived exiftool process, started on first use and shared by all video lookups of a run
+        self.exiftool_session = None
+        self.exiftool_unavailable = False
+        # files whose metadata could not be read (e.g. permission denied), their missing dates and hashes are not cached
+        self.unreadable_files = set()
+        # persistent capture timestamp cache of the given folder, None if bypassed with --no_cache
+        self.metadata_cache = None
+        # files of the given folder, scanned once and kept up to date by updateAfterMove()
+        self.inventory = None
+        # append-only log of all executed move plans of the given folder
+        self.move_journal = None
+        # folder mtimes and file sizes/mtimes as of the last ingest (mode 9)
+        self.tree_snapshot = None
+        # phase timings and counters of the run, only recorded with --profile or --stats_json
+        self.stats = RunStats()
+
     def main(self):
         mode_map = {0: 'show folder statistics (recursive, read-only)',
                     1: 'show capture timestamps grouped by year (recursive, read-only)',
@@ -41,12 +99,29 @@ class PictureMagic(object):
                     5: 'move to monthly subfolders',
                     6: 'safely move back from any direct subfolders (renaming if names clash)',
                     7: 'safely remove renaming-suffix from previous safe moving (recursive)',
+                    8: 'undo the last run of modes 3-7 or 9 (replays the move journal backwards,\n'
+                       f'    up to {MoveJournal.max_undoable_runs} runs back)',
+                    9: 'ingest new files into type or monthly subfolders (only files added since the last run)',
+                    10: 'find similar images (e.g. re-compressed copies) and remove them interactively\n'
+                        '     (recursive, needs Pillow and numpy)',
+                    11: 'delete the files of a deletion plan written by mode 2 or 10 with --keep_rules\n'
+                        '     (or move them into _Quarantine with --quarantine)',
                     }
 
         dict_to_str = lambda x: '\n'.join("  %s:%s" % (str(k), str(v)) for (k, v) in x.items()) if isinstance(x,dict) else x
+        def modes_list(value):
+            try:
+                modes = [int(mode) for mode in value.split(',')]
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"invalid mode sequence: '{value}'")
+            unknown = [mode for mode in modes if mode not in mode_map]
+            if unknown:
+                raise argparse.ArgumentTypeError(f"unknown mode {unknown[0]} (choose from {', '.join(map(str, mode_map))})")
+            return modes
         parser = argparse.ArgumentParser(description='Organize pictures from iOS', formatter_class=argparse.RawTextHelpFormatter)
-        parser.add_argument('--mode', dest='mode', required=True, type=int, choices=mode_map.keys(),
-                           help=f'mode of operation.\n{dict_to_str(mode_map)}')
+        parser.add_argument('--mode', dest='mode', required=True, type=modes_list, metavar='MODE[,MODE...]',
+                           help=f'mode of operation, or a comma separated sequence of modes that are run one after\n'
+                                f'the other and share one folder scan (e.g. 0,3,5).\n{dict_to_str(mode_map)}')
         parser.add_argument('--path', dest='path', required=True, type=str,
                            help='path to a folder.')
         parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true',
@@ -54,12 +129,104 @@ class PictureMagic(object):
                                 'only output the planned operations.')
         parser.add_argument('--verbose', dest='verbose', required=False, action='store_true',
                            help='If true, print verbose log information.')
+        parser.add_argument('--workers', dest='workers', required=False, type=int, default=1,
+                           help='Number of parallel capture timestamp lookups (modes 1 and 5), image hashes (mode 10)\n'
+                                'and copies when moving files to another device. Default: 1')
+        parser.add_argument('--no_cache', dest='no_cache', required=False, action='store_true',
+                           help=f'If true, neither read nor update the capture timestamp cache in {self.dirname_state}.')
+        parser.add_argument('--rebuild_cache', dest='rebuild_cache', required=False, action='store_true',
+                           help='If true, discard the capture timestamp cache and extract all timestamps again.')
+        parser.add_argument('--by_content', dest='by_content', required=False, action='store_true',
+                           help='If true, mode 2 finds files with equal content (regardless of their names) '
+                                'instead of files with equal name and size.')
+        parser.add_argument('--ingest_into', dest='ingest_into', required=False, type=str, default='type',
+                           choices=['type', 'month'],
+                           help='Where mode 9 moves new files: into the type subfolders of mode 3 (only files\n'
+                                'directly in the folder) or into the monthly subfolders of mode 5. Default: type')
+        parser.add_argument('--interval', dest='interval', required=False, type=float, default=None,
+                           help='If given, mode 9 keeps running and checks for new files every INTERVAL seconds.\n'
+                                'Files are only moved once they are unchanged between two checks.')
+        parser.add_argument('--max_distance', dest='max_distance', required=False, type=int, default=6,
+                           help='Number of bits (of 64) in which the image hashes of two images may differ for\n'
+                                'mode 10 to consider them similar. Default: 6')
+        parser.add_argument('--date_sources', dest='date_sources', required=False, type=self.parseDateSources,
+                           default=list(self.date_sources),
+                           help='Comma separated sources of the capture dates for mode 5 (and mode 9 with\n'
+                                '--ingest_into month), tried in the given order until one knows the date of a file.\n'
+                                f'Default: {",".join(self.date_sources)}\n{dict_to_str(self.date_sources)}')
+        parser.add_argument('--keep_rules', dest='keep_rules', required=False, type=self.parseKeepRules, default=None,
+                           help='Comma separated rules, with which modes 2 and 10 choose the copies to keep instead\n'
+                                'of asking. They only write a deletion plan to review, mode 11 carries it out.\n'
+                                f'{dict_to_str(self.keep_rules)}')
+        parser.add_argument('--plan', dest='plan', required=False, type=str, default=None,
+                           help=f'Deletion plan written by modes 2 and 10 and read by mode 11.\n'
+                                f'Default: {self.filename_deletion_plan} in {self.dirname_state}')
+        parser.add_argument('--quarantine', dest='quarantine', required=False, action='store_true',
+                           help=f'If true, mode 11 moves the files into {self.dirname_quarantine} instead of deleting '
+                                f'them (undo with mode 8).')
+        parser.add_argument('--profile', dest='profile', required=False, action='store_true',
+                           help='If true, print the wall time per phase and counters of the expensive operations\n'
+                                '(files scanned, stat calls, metadata bytes read, subprocesses, moves) at the end.')
+        parser.add_argument('--stats_json', dest='stats_json', required=False, type=str, default=None,
+                           help='Write the phase timings and counters of --profile as JSON to this file.')
+        parser.add_argument('--cprofile', dest='cprofile', required=False, type=str, default=None,
+                           help='Run under cProfile and dump its statistics to this file (readable with pstats).')
 
         args = parser.parse_args()
-        print("Running program in mode: {}".format(args.mode))
         if not os.path.isdir(args.path):
             print("The given folder {} does not exist. Exit.".format(args.path))
             return
+        if args.workers < 1:
+            print("The number of workers must be at least 1. Exit.")
+            return
+        if args.interval is not None and args.interval <= 0:
+            print("The interval must be positive. Exit.")
+            return
+        if not 0 <= args.max_distance <= 64:
+            print("The maximum distance must be between 0 and 64. Exit.")
+            return
+
+        folder_path = Path(args.path.rstrip(os.sep))
+        if not args.no_cache:
+            self.metadata_cache = MetadataCache(folder_path, folder_path / self.dirname_state, args.rebuild_cache)
+        self.move_journal = MoveJournal(folder_path, folder_path / self.dirname_state)
+        self.tree_snapshot = TreeSnapshot(folder_path, folder_path / self.dirname_state)
+        self.stats = RunStats(enabled=args.profile or args.stats_json is not None)
+        profiler = None
+        if args.cprofile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self.stats.phase("total"):
+                for mode in args.mode:
+                    # every step gets its own arguments, the inventory, caches and journal are shared
+                    step_args = argparse.Namespace(**vars(args))
+                    step_args.mode = mode
+                    print("Running program in mode: {}".format(mode))
+                    with self.stats.phase(f"mode {mode}"):
+                        self.runMode(step_args)
+        finally:
+            self.closeExifToolSession()
+            if self.metadata_cache is not None:
+                self.metadata_cache.close()
+            self.move_journal.close()
+            self.tree_snapshot.close()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.cprofile)
+            self.reportStats(args)
+
+    def reportStats(self, args):
+        if args.profile:
+            self.stats.printReport()
+        if args.stats_json:
+            self.stats.writeJson(args.stats_json, mode=args.mode, path=args.path)
+            print(f"Run statistics written to {args.stats_json}")
+
+    def runMode(self, args):
+        if args.mode in self.moving_modes and not self.resumeInterruptedRun(args):
+            return
 
         if args.mode==0:
             self.showStats(args)
@@ -77,17 +244,27 @@ class PictureMagic(object):
             self.safeMoveFromSubfolders(args)
         elif args.mode == 7:
             self.removeRenamingSuffixes(args)                         
+        elif args.mode == 8:
+            self.undoLastRun(args)
+        elif args.mode == 9:
+            self.ingestNewFiles(args)
+        elif args.mode == 10:
+            self.findSimilarImages(args)
+        elif args.mode == 11:
+            self.applyDeletionPlan(args)
 
     ###############################################################################################################
     # Mode 0 - show file statistics (READ-ONLY)
     def showStats(self, args):
         folder_path = Path(args.path.rstrip(os.sep))
-        files = [path.suffix for path in folder_path.glob("**/*") if path.is_file() and path.suffix]
-        data = collections.Counter(files)
-        for key, val in data.items():
-            print(f'{key}: {val}')
+        by_suffix = self.getInventory(folder_path).bySuffix()
+        num_files = 0
+        for key, records in by_suffix.items():
+            if key:
+                print(f'{key}: {len(records)}')
+                num_files += len(records)
         print(f"-----------------------------")
-        print(f"Overall: {len(files)} files")
+        print(f"Overall: {num_files} files")
 
 
     ###############################################################################################################
@@ -96,17 +273,12 @@ class PictureMagic(object):
     def showCaptureYears(self, args):               
         folder_path = Path(args.path.rstrip(os.sep))
         collection = collections.defaultdict(list)
-        files = [path for path in folder_path.glob("**/*") if path.is_file()]
-        for file_path in files:
-            dt = None
-            lower_name = str(file_path).lower()
-            if lower_name.endswith("jpg") or lower_name.endswith("jpeg") or lower_name.endswith("png"):
-                dt = self.getImageCaptureTimestamp(file_path)
-            elif lower_name.endswith("mov") or lower_name.endswith("mp4"):
-                dt = self.getVideoCaptureTimestamp(file_path)
-            
+        files = list(self.getInventory(folder_path))
+        timestamps = self.getCaptureTimestamps(files, args.workers)
+        for record in files:
+            dt = timestamps[record.path]
             key = str(dt[0:4]) if (dt is not None and len(dt)>7) else 'Unknown'
-            collection[key].append(file_path)
+            collection[key].append(record.path)
 
         num_overall = 0
         sorted_keys = sorted(collection.keys())
@@ -123,45 +295,213 @@ class PictureMagic(object):
     # Also returns duplicates in the form {filename: num_occurrences}
     def findDuplicates(self, args, doConsiderSize, doLogging): 
         folder_path = Path(args.path.rstrip(os.sep))
+        if doConsiderSize and args.by_content:
+            return self.findContentDuplicates(args, doLogging)
+
+        # index {(filename, size): [paths]}, built in a single scan and used for all duplicate groups
+        dup_index = collections.defaultdict(list)
+        for record in self.getInventory(folder_path, progress=doLogging):
+            dup_index[(record.name, str(record.size) if doConsiderSize else '')].append(record.path)
+
         dups = {}
-        files = [(os.path.basename(path), str(os.path.getsize(path)) if doConsiderSize else '') for path in folder_path.glob("**/*") if path.is_file()]
-        data = collections.Counter(files)
-        for key, val in data.items():
-            if (val > 1):
-                dups[key] = val
+        for key, paths in dup_index.items():
+            if len(paths) > 1:
+                dups[key] = len(paths)
                 if doLogging:
-                    print(f'Duplicate file name: {key} -> occurs {val} times')
+                    print(f'Duplicate file name: {key} -> occurs {len(paths)} times')
         if doLogging:
             print(f'Found {len(dups)} duplicates')
+            if doConsiderSize:
+                reclaimable = sum(int(key[1]) * (num - 1) for key, num in dups.items())
+                print(f'{self.formatSize(reclaimable)} could be reclaimed by keeping only one file of each duplicate')
         
-        if doConsiderSize and not args.dry_run: 
-            count = 0
-            for key, num in dups.items():
-                count += 1
-                dup_files = [path for path in folder_path.glob("**/*"+key[0]) if str(os.path.getsize(path))==key[1]]
-                if len(dup_files) != num:
-                    raise Exception(f"{len(dup_files)} vs {num}")
-                
-                msg = f"\n\n{count}/{len(dups)}: File {key[0]} exists {num} times."
-                for dcount,dup in enumerate(dup_files):
-                    msg += f"\n{dcount}: {dup}"
-                msg += "\n\n(S)kip, (A)bort, (0) Delete 0, (1) Delete 1, ...\n"
-                answer = "TBD"
-                while answer.lower() not in ["s", "a"] + [str(n) for n in list(range(num))]:
-                    answer = input(msg)
-                if answer=="s":
+        if doConsiderSize:
+            self.resolveDuplicates(args, dups, dup_index.get, verify_content=True)
+
+        return dups
+
+
+    # Mode 2 with --by_content - find files with equal content, regardless of their names
+    # Files are grouped by size, then by a hash of their first/last bytes, and only files that still
+    # collide are hashed completely. Returns duplicates in the form {(content_hash, size): num_occurrences}
+    def findContentDuplicates(self, args, doLogging):
+        folder_path = Path(args.path.rstrip(os.sep))
+
+        by_size = collections.defaultdict(list)
+        for record in self.getInventory(folder_path, progress=doLogging):
+            if record.size > 0:
+                by_size[record.size].append(record.path)
+        candidates = {size: paths for size, paths in by_size.items() if len(paths) > 1}
+        if doLogging:
+            print(f'{sum(len(paths) for paths in candidates.values())} files share their size with another file')
+
+        by_partial_hash = collections.defaultdict(list)
+        with self.stats.phase("hashing"):
+            for size, paths in candidates.items():
+                for path in paths:
+                    by_partial_hash[(self.hashFile(path, partial=True), size)].append(path)
+        candidates = {key: paths for key, paths in by_partial_hash.items() if len(paths) > 1}
+        if doLogging:
+            print(f'{sum(len(paths) for paths in candidates.values())} files share their first and last {self.partial_hash_size} bytes with another file')
+
+        dup_groups = {}
+        with self.stats.phase("hashing"):
+            for (partial_hash, size), paths in candidates.items():
+                if size <= 2 * self.partial_hash_size:
+                    # the partial hash already covered the whole file
+                    dup_groups[(partial_hash, size)] = paths
                     continue
-                elif answer=="a":
-                    break
-                else:
-                    delIndex = int(answer)
-                    print(f"Deleting {delIndex}: {dup_files[delIndex]}")
-                    time.sleep(1)
-                    os.remove(dup_files[delIndex])
+                by_full_hash = collections.defaultdict(list)
+                for path in paths:
+                    by_full_hash[self.hashFile(path, partial=False)].append(path)
+                for content_hash, same_paths in by_full_hash.items():
+                    if len(same_paths) > 1:
+                        dup_groups[(content_hash, size)] = same_paths
 
+        dups = {key: len(paths) for key, paths in dup_groups.items()}
+        if doLogging:
+            for key, paths in dup_groups.items():
+                print(f'Duplicate file content: {os.path.basename(paths[0])} ({key[1]} bytes) -> occurs {len(paths)} times')
+            print(f'Found {len(dups)} duplicates')
+            reclaimable = sum(key[1] * (num - 1) for key, num in dups.items())
+            print(f'{self.formatSize(reclaimable)} could be reclaimed by keeping only one file of each duplicate')
+
+        self.resolveDuplicates(args, dups, dup_groups.get)
         return dups
 
 
+    # removes duplicates interactively, or with --keep_rules writes a deletion plan for mode 11
+    def resolveDuplicates(self, args, dups, get_dup_files, verify_content=False, image_hashes=None):
+        if args.keep_rules:
+            self.writeDeletionPlan(args, dups, get_dup_files, verify_content, image_hashes)
+        elif not args.dry_run:
+            self.removeDuplicatesInteractively(dups, get_dup_files)
+
+    # asks for each duplicate which of its files shall be deleted
+    # dups is {key: num_occurrences}, get_dup_files(key) returns the paths of the duplicate files
+    def removeDuplicatesInteractively(self, dups, get_dup_files):
+        count = 0
+        for key, num in dups.items():
+            count += 1
+            dup_files = get_dup_files(key)
+            if len(dup_files) != num:
+                raise Exception(f"{len(dup_files)} vs {num}")
+            
+            msg = f"\n\n{count}/{len(dups)}: File {os.path.basename(dup_files[0])} exists {num} times."
+            for dcount,dup in enumerate(dup_files):
+                msg += f"\n{dcount}: {dup}"
+            msg += "\n\n(S)kip, (A)bort, (0) Delete 0, (1) Delete 1, ...\n"
+            answer = "TBD"
+            while answer.lower() not in ["s", "a"] + [str(n) for n in list(range(num))]:
+                answer = input(msg)
+            if answer=="s":
+                continue
+            elif answer=="a":
+                break
+            else:
+                delIndex = int(answer)
+                print(f"Deleting {delIndex}: {dup_files[delIndex]}")
+                time.sleep(1)
+                os.remove(dup_files[delIndex])
+                if self.inventory is not None:
+                    self.inventory.remove(str(dup_files[delIndex]))
+
+    # Chooses the copies to keep of each duplicate with the --keep_rules and writes all others into a deletion
+    # plan, which can be reviewed (and edited) before mode 11 deletes them. With verify_content, copies whose
+    # content differs from the kept one (equal name and size only) are kept as well. With image_hashes
+    # ({file_path: int} of mode 10), images not within --max_distance of a kept one are kept as well.
+    def writeDeletionPlan(self, args, dups, get_dup_files, verify_content, image_hashes=None):
+        plan_path = self.deletionPlanPath(args)
+        num_deletions = 0
+        num_bytes = 0
+        lines = [f"# Deletion plan of mode {args.mode} for {os.path.abspath(args.path)}",
+                 f"# Keep rules: {','.join(args.keep_rules)}",
+                 "# Review it and change 'delete' into 'keep' (or the other way round) where needed, then run mode 11",
+                 "# to delete the files. Groups without an existing 'keep' file are skipped by mode 11.",
+                 ""]
+        for count, key in enumerate(dups, 1):
+            dup_files = get_dup_files(key)
+            keep = self.chooseCopiesToKeep(dup_files, args.keep_rules, args.path)
+            kept_hashes = None
+            kept_images = list(keep)
+            lines.append(f"# {count}/{len(dups)}: {os.path.basename(dup_files[0])} exists {len(dup_files)} times")
+            for dup in dup_files:
+                if dup not in keep and verify_content:
+                    if kept_hashes is None:
+                        kept_hashes = {self.hashFile(kept, partial=False) for kept in keep}
+                    if self.hashFile(dup, partial=False) not in kept_hashes:
+                        lines.append("# the content of the next file differs from the kept copies")
+                        keep.append(dup)
+                if dup not in keep and image_hashes is not None:
+                    if not any(BKTree.distance(image_hashes[dup], image_hashes[kept]) <= args.max_distance
+                               for kept in kept_images):
+                        lines.append("# the next image is not similar to the kept copies")
+                        keep.append(dup)
+                if dup in keep:
+                    lines.append(f"keep\t{os.path.abspath(dup)}")
+                else:
+                    lines.append(f"delete\t{os.path.abspath(dup)}")
+                    num_deletions += 1
+                    num_bytes += os.path.getsize(dup)
+            lines.append("")
+
+        os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+        with open(plan_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines))
+        print(f"Wrote deletion plan of {num_deletions} files ({self.formatSize(num_bytes)}) to {plan_path}")
+        print("Review it, then run mode 11 to delete the files (or to move them into quarantine with --quarantine)")
+
+    # the copies of a duplicate group that are kept: the best one by the preference rules, plus the copies
+    # the keep_outside rules protect
+    def chooseCopiesToKeep(self, dup_files, rules, folder_path):
+        root = os.path.abspath(folder_path)
+        def inFolder(file_path, folder_name):
+            return folder_name in os.path.relpath(os.path.dirname(os.path.abspath(file_path)), root).split(os.sep)
+        def rank(file_path):
+            record = self.inventory.get(str(file_path)) if self.inventory is not None else None
+            if record is None:
+                stat = os.stat(file_path)
+                record = FileRecord(os.path.basename(file_path), os.path.dirname(file_path), None,
+                                    stat.st_size, stat.st_mtime_ns)
+            key = []
+            for rule in rules:
+                if rule.startswith('folder:'):
+                    key.append(not inFolder(file_path, rule.split(':', 1)[1]))
+                elif rule == 'shortest_path':
+                    key.append(len(str(file_path)))
+                elif rule == 'oldest':
+                    key.append(record.mtime_ns)
+                elif rule == 'newest':
+                    key.append(-record.mtime_ns)
+                elif rule == 'largest':
+                    key.append(-record.size)
+            return key + [str(file_path)]
+
+        ranked = sorted(dup_files, key=rank)
+        keep = [ranked[0]]
+        for rule in rules:
+            if rule.startswith('keep_outside:'):
+                outside = [dup for dup in ranked if not inFolder(dup, rule.split(':', 1)[1])]
+                if outside and not any(dup in outside for dup in keep):
+                    keep.append(outside[0])
+        return keep
+
+    @classmethod
+    def parseKeepRules(cls, value):
+        rules = [rule.strip() for rule in value.split(',') if rule.strip()]
+        for rule in rules:
+            name, _, folder_name = rule.partition(':')
+            known = name + (':NAME' if folder_name else '')
+            if known not in cls.keep_rules or (known.endswith(':NAME') and not folder_name):
+                raise argparse.ArgumentTypeError(f"unknown keep rule '{rule}' (choose from {', '.join(cls.keep_rules)})")
+        return rules
+
+    def deletionPlanPath(self, args):
+        if args.plan:
+            return args.plan
+        return os.path.join(args.path.rstrip(os.sep), self.dirname_state, self.filename_deletion_plan)
+
+
     ###############################################################################################################
     # Mode 3 - move to type subfolders
     def moveToSubfolders(self, args):
@@ -169,54 +509,87 @@ class PictureMagic(object):
         if not self.checkIfDirWithNonReservedName(folder_path):
             return
 
-        # TODO: Since we don't really move in dry_run, the number of matching files is not equal to normal mode
-        #       if a file matches multiple criteriums
-        # TODO: For performance reasons it would be way better if we only iterate once over all files.
-        #       If we classify each file in one run (criterium after criterium) and store what is going to
-        #       happen with each file we could avoid this problem AND the one above.
+        # Each file is classified once and assigned to the first matching subfolder, so a dry run
+        # reports the same numbers as a real run.
+        files = self.getInventory(folder_path, max_depth=0).filesIn(folder_path)
+        categories = self.classifyForSubfolders(list(files))
+        plan = MovePlan()
+        for subdir_name in self.special_folders:
+            matching_files = [record.path for name, record in files.items() if categories[name] == subdir_name]
+            self.planMovesToSubfolder(args.dry_run, folder_path, subdir_name, matching_files, plan)
+        self.executeMovePlan(args, plan)
+
+
+    # Assigns each file name of a folder to its type subfolder, returns {name: subdir_name or None}.
+    # The criteria are checked in the order of special_folders, the first matching one wins.
+    # Twins (live image JPGs, edited IMG_E files) are looked up in a set of the file names instead of on disk.
+    # twin_names are names of files that are not classified but count as twins, e.g. files sorted in earlier.
+    def classifyForSubfolders(self, names, twin_names=()):
+        names_set = set(names).union(twin_names)
+        img_pattern = re.compile(r"^img_.*\.(jpg|jpeg|mov)$", re.IGNORECASE)
 
         # Folder: _EditDataAAE
         # All files with type AAE (*.AAE)
-        criterion_aae = lambda curr_file, curr_folder: True if curr_file.lower().endswith('aae') else False
-        self.createSubfolderAndMove(args.dry_run, args.verbose, folder_path, self.dirname_aae, criterion_aae)
+        criterion_aae = lambda curr_file: curr_file.lower().endswith('aae')
 
         # Folder: _WhatsApp, Downloads, etc
         # All files that do not start with IMG_*  OR
         # that have a type other than JPG, JPEG or MOV
         # TODO: JPG files named IMG* that have an empty "Date taken" (WhatsApp clears all EXIF data)
-        criterion_downloads = lambda curr_file, curr_folder: True if not re.match(r"^img_.*\.(jpg|jpeg|mov)$", curr_file, re.IGNORECASE) else False
-        self.createSubfolderAndMove(args.dry_run, args.verbose, folder_path, self.dirname_downloads, criterion_downloads)
+        criterion_downloads = lambda curr_file: not img_pattern.match(curr_file)
 
         # Folder: _LiveImages
         # All MOV files for which a corresponding JPG file (with the same name) exists.
         # --> IMG_0433.MOV, IMG_E0910.MOV
-        def criterion_live_imgs(curr_file, curr_folder):
+        def criterion_live_imgs(curr_file):
             suffix = Path(curr_file).suffix
             if suffix.lower() == '.mov':
                 for img_suffix in ['.jpg', '.jpeg', '.JPG', '.JPEG']:
                     potential_twin_file = img_suffix.join(curr_file.rsplit(suffix, 1)) # replace only last occurrence of .MOV with .JPG
-                    if os.path.isfile(os.path.join(curr_folder, potential_twin_file)):
+                    if potential_twin_file in names_set:
                         return True
             return False
-        self.createSubfolderAndMove(args.dry_run, args.verbose, folder_path, self.dirname_live_imgs, criterion_live_imgs)
 
+        categories = {}
+        for name in names:
+            if criterion_aae(name):
+                categories[name] = self.dirname_aae
+            elif criterion_downloads(name):
+                categories[name] = self.dirname_downloads
+            elif criterion_live_imgs(name):
+                categories[name] = self.dirname_live_imgs
+            else:
+                categories[name] = None
 
-        # TODO: This is not so efficient, since we check all IMG_ files for matching IMG_E instead vice versa.
-        #       Also no warnings for IMG_E without matching Original is possible.
         # Folder: _Originals
         # Contains all files IMG_<num>.xxx for which an edited version IMG_E<num>.xxx exists.
-        def criterion_originals(curr_file, curr_folder):
+        # The edited version only counts if it is not moved to one of the subfolders above.
+        remaining = {name for name, category in categories.items() if category is None}
+        def criterion_originals(curr_file):
             if curr_file.startswith('IMG_'):
                 potential_twin_file = 'IMG_E'.join(curr_file.split('IMG_', 1))  # replace only first occurrence of IMG_ with IMG_E
-                if os.path.isfile(os.path.join(curr_folder, potential_twin_file)):
+                if potential_twin_file in remaining or potential_twin_file in twin_names:
                     return True
             return False
-        self.createSubfolderAndMove(args.dry_run, args.verbose, folder_path, self.dirname_originals, criterion_originals)
 
-        # # Folder: Pics_and_Movies
-        # # All remaining files. Should be only JPG, JPEG or MOV, where MOV is NOT a live video.
-        criterion_remaining = lambda curr_file, curr_folder: True if re.match(r"^img_.*\.(jpg|jpeg|mov)$", curr_file, re.IGNORECASE) else False
-        self.createSubfolderAndMove(args.dry_run, args.verbose, folder_path, self.dirname_remaining, criterion_remaining)
+        # Folder: Pics_and_Movies
+        # All remaining files. Should be only JPG, JPEG or MOV, where MOV is NOT a live video.
+        criterion_remaining = lambda curr_file: bool(img_pattern.match(curr_file))
+
+        for name in remaining:
+            if criterion_originals(name):
+                categories[name] = self.dirname_originals
+            elif criterion_remaining(name):
+                categories[name] = self.dirname_remaining
+
+        # edited files without original, e.g. because the original was deleted or never synced
+        for name in sorted(names):
+            if re.match(r"^IMG_E[0-9]", name):
+                original = 'IMG_' + name[len('IMG_E'):]
+                if original not in names_set:
+                    print(f"WARNING: Edited file {name} has no original {original}")
+
+        return categories
 
 
     ###############################################################################################################
@@ -234,137 +607,582 @@ class PictureMagic(object):
                 print(f'Duplicate file name: {key} -> occurs {val} times')   
             return         
 
-        self.moveToParentAndDeleteSubfolder(args.dry_run, args.verbose, folder_path, self.dirname_aae)
-        self.moveToParentAndDeleteSubfolder(args.dry_run, args.verbose, folder_path, self.dirname_downloads)
-        self.moveToParentAndDeleteSubfolder(args.dry_run, args.verbose, folder_path, self.dirname_live_imgs)
-        self.moveToParentAndDeleteSubfolder(args.dry_run, args.verbose, folder_path, self.dirname_originals)
-        self.moveToParentAndDeleteSubfolder(args.dry_run, args.verbose, folder_path, self.dirname_remaining)
+        plan = MovePlan()
+        for subdir_name in self.special_folders:
+            self.planMovesToParent(args.dry_run, folder_path, subdir_name, plan)
+        self.executeMovePlan(args, plan)
         print("Done!")
 
     ###############################################################################################################
     # Mode 5 - move to monthly subfolders
     def moveToMonthlySubfolders(self, args):
-        monthly = True  # Set to False for yearly subfolders!!!
-        
         folder_path = Path(args.path.rstrip(os.sep))
+        plan = MovePlan()
+        self.planMovesToMonthlySubfolders(args, folder_path, list(self.getInventory(folder_path)), plan)
+        self.executeMovePlan(args, plan)
+
+    # adds the moves of the given inventory records into the monthly subfolders of folder_path to the plan
+    def planMovesToMonthlySubfolders(self, args, folder_path, files, plan):
+        monthly = True  # Set to False for yearly subfolders!!!
+
         collection = collections.defaultdict(list)
-        for file_path in Path(folder_path).glob('**/*'):
-            lower_name = str(file_path).lower()
-            dt = None
-            if lower_name.endswith("jpg") or lower_name.endswith("jpeg") or lower_name.endswith("png"):
-                dt = self.getImageCaptureTimestamp(file_path)
-            elif lower_name.endswith("mov") or lower_name.endswith("mp4"):
-                dt = self.getVideoCaptureTimestamp(file_path)
-            
+        timestamps, sources = self.resolveCaptureDates(files, args.workers, args.date_sources)
+        source_counts = collections.Counter(sources.get(record.path, 'unknown') for record in files)
+        print("Capture dates: " + ", ".join(f"{source_counts[source]} from {source}" for source in args.date_sources) +
+              f", {source_counts['unknown']} unknown")
+        for record in files:
+            if args.verbose: print(f"{record.path}: {timestamps[record.path]} ({sources.get(record.path, 'unknown')})")
+            dt = timestamps[record.path]
             key = 'Unknown'
             if dt is not None and len(dt)>7:
                 key = str(dt[0:4]) + "_" + str(dt[5:7]) if monthly else str(dt[0:4])
-            collection[key].append(file_path)
-            
+            collection[key].append(record.path)
+
+        planned_targets = set()
         for key,files in collection.items():
             subfolder_path = os.path.join(folder_path, key)
             print(f"{subfolder_path}: {len(files)} items")
             if not os.path.exists(subfolder_path):
                 print(f"Create new subfolder {subfolder_path}")
-                if not args.dry_run: 
-                    os.makedirs(subfolder_path)
             for f in files:
-                if args.verbose: 
-                    print(f"Moving file {f} to subfolder {subfolder_path}")
-                if not args.dry_run: 
-                    shutil.move(f, subfolder_path)       
+                target_path = os.path.join(subfolder_path, os.path.basename(f))
+                if target_path == f:
+                    continue
+                if target_path in planned_targets or os.path.lexists(target_path):
+                    print(f"CANNOT move {f} to subfolder {subfolder_path} because this filename exists already")
+                    continue
+                planned_targets.add(target_path)
+                plan.add(f, target_path)
     
 
+    # Capture dates of the given inventory records, resolved by the date sources in the given order: each source
+    # only gets the files that the ones before left without date, so the metadata is only read where the file name
+    # or a twin does not tell the date. Returns ({file_path: timestamp or None}, {file_path: source}).
+    def resolveCaptureDates(self, records, workers, date_sources):
+        timestamps = {record.path: None for record in records}
+        sources = {}
+        twins = collections.defaultdict(list)
+        if 'twin' in date_sources:
+            for record in records:
+                key = self.twinKey(record)
+                if key is not None:
+                    twins[key].append(record)
+
+        def resolve(record, dt, source):
+            timestamps[record.path] = dt
+            sources[record.path] = source
+
+        def resolveTwins():
+            for members in twins.values():
+                dt = next((timestamps[member.path] for member in members if member.path in sources), None)
+                if dt is not None:
+                    for member in members:
+                        if member.path not in sources:
+                            resolve(member, dt, 'twin')
+
+        use_twins = False
+        for source in date_sources:
+            unresolved = [record for record in records if record.path not in sources]
+            if source == 'filename':
+                for record in unresolved:
+                    dt = self.parseFilenameDate(record.name)
+                    if dt is not None:
+                        resolve(record, dt, source)
+            elif source == 'twin':
+                use_twins = True
+            elif source == 'metadata':
+                candidates = [record for record in unresolved
+                              if record.name.lower().endswith(self.image_suffixes + self.video_suffixes)]
+                # of a group of twins only one file is read at a time (images first, they are read faster),
+                # the others take its date
+                queues = collections.defaultdict(list)
+                for record in candidates:
+                    key = self.twinKey(record) if use_twins else None
+                    queues[key if key is not None else record.path].append(record)
+                for queue in queues.values():
+                    queue.sort(key=lambda record: not record.name.lower().endswith(self.image_suffixes))
+                while queues:
+                    batch = [queue.pop(0) for queue in queues.values()]
+                    for record, dt in zip(batch, self.getCaptureTimestamps(batch, workers).values()):
+                        if dt is not None:
+                            resolve(record, dt, source)
+                    if use_twins:
+                        resolveTwins()
+                    queues = {key: [record for record in queue if record.path not in sources]
+                              for key, queue in queues.items()}
+                    queues = {key: queue for key, queue in queues.items() if queue}
+            elif source == 'mtime':
+                for record in unresolved:
+                    dt = datetime.datetime.fromtimestamp(record.mtime_ns / 1e9)
+                    resolve(record, dt.strftime("%Y:%m:%d %H:%M:%S"), source)
+            if use_twins:
+                resolveTwins()
+        return timestamps, sources
+
+    # key shared by twins: IMG_0001.JPG, IMG_0001.MOV (live photo), IMG_E0001.JPG (edited), IMG_0001.AAE and
+    # IMG_O0001.AAE, also after mode 3 sorted them into different type subfolders. None for other files.
+    def twinKey(self, record):
+        match = re.match(r"^IMG_[EO]?(\d+)$", os.path.splitext(record.name)[0], re.IGNORECASE)
+        if match is None:
+            return None
+        group_dir = os.path.dirname(record.dir) if os.path.basename(record.dir) in self.special_folders else record.dir
+        return group_dir, match.group(1)
+
+    # capture date in the format of the Exif data from a date in the file name, None if there is none
+    @classmethod
+    def parseFilenameDate(cls, name):
+        match = cls.filename_date_pattern.search(name)
+        if match is None:
+            return None
+        year, month, day, hour, minute, second = (int(value) if value else 0 for value in match.groups())
+        try:
+            dt = datetime.datetime(year, month, day, hour, minute, second)
+        except ValueError:
+            return None  # e.g. February 30th
+        return dt.strftime("%Y:%m:%d %H:%M:%S")
+
+    @classmethod
+    def parseDateSources(cls, value):
+        sources = [source.strip() for source in value.split(',') if source.strip()]
+        for source in sources:
+            if source not in cls.date_sources:
+                raise argparse.ArgumentTypeError(f"unknown date source '{source}' (choose from {', '.join(cls.date_sources)})")
+        return sources
+
+
     ###############################################################################################################
     # Mode 6 - move from direct subfolders (non-recursively) to this folder
     #          name clashes are avoided by renaming a file before moving if necessary
     def safeMoveFromSubfolders(self, args):
-        # TODO
-        if args.dry_run:
-            print("DRY_RUN is not available for this mode. Quit!")
-            return        
-        
         # non recursive, also ignores files directly in folder_path
         folder_path = Path(args.path.rstrip(os.sep))
-        files = [path for path in Path(folder_path).glob("*/*") if path.is_file()]
+        inventory = self.getInventory(folder_path, max_depth=1)
+        files = [record.path for record in inventory if os.path.dirname(record.dir) == inventory.root]
+        plan = MovePlan()
+        # names in folder_path, including the ones claimed by earlier moves of the plan
+        names = NameAllocator.fromFolder(folder_path)
         for f in files:   
-            target_path = os.path.join(folder_path, os.path.basename(f))
-            #print(f"{f}   -->  {target_path}")
-
-            if os.path.isfile(target_path):
-                print(f"File {target_path} already exists ...")
-                num = 0
-                while True:                    
-                    num = num + 1
-                    tp_pre, tp_ext = os.path.splitext(target_path)
-                    target_path_renamed = tp_pre + "__" + f"{num:03}" + tp_ext
-                    if not os.path.isfile(target_path_renamed):
-                        target_path = target_path_renamed
-                        print(f"...renaming to {os.path.basename(target_path)} when moving from subfolder {os.path.basename(os.path.dirname(f))}")
-                        break
-            shutil.move(f, target_path)      
+            name = os.path.basename(f)
+            target_name = names.claimFreeName(name)
+            if target_name != name:
+                print(f"File {os.path.join(folder_path, name)} already exists ...")
+                print(f"...renaming to {target_name} when moving from subfolder {os.path.basename(os.path.dirname(f))}")
+            plan.add(f, os.path.join(folder_path, target_name))
+        self.executeMovePlan(args, plan)
 
 
     ###############################################################################################################
     # Mode 7 - move from direct subfolders (non-recursively) to this folder
     #          name clashes are avoided by renaming a file before moving if necessary
     def removeRenamingSuffixes(self, args):
-        # TODO: Dry mode can give different results
-        #       e.g. if files A/img_001.JPG and B/img_002.jpg exist, we only
-        #       for an existing file img.JPG in current folder when in dry_mode -> NO PROBLEM
-        #       In reality, the first renaming will create such a file, so the second one won't work! 
-
+        # The renamings are planned against the names each folder will have at that point of the real run,
+        # so a dry run gives the same results as a real run.
         folder_path = Path(args.path.rstrip(os.sep))
-        files = [path for path in folder_path.glob("**/*") if path.is_file() and re.match(r".*__[0-9][0-9][0-9]\.[a-z]+$", os.path.basename(path), re.IGNORECASE)]
-        renameOk = 0
+        files = sorted(record.path for record in self.getInventory(folder_path) if re.match(r".*__[0-9][0-9][0-9]\.[a-z]+$", record.name, re.IGNORECASE))
+        plan = MovePlan()
+        names_by_folder = {}
         for f in files:
+            folder, name = os.path.split(f)
+            if folder not in names_by_folder:
+                names_by_folder[folder] = NameAllocator.fromFolder(folder)
+            names = names_by_folder[folder]
             path_pre, path_ext = os.path.splitext(f)
             renamed_f = path_pre[0:path_pre.rfind("__")] + path_ext
-            if not os.path.isfile(renamed_f):
-                renameOk += 1
-                if not args.dry_run:
-                    shutil.move(f, renamed_f) 
-                    print(f"RENAMED {f} to {renamed_f}\n") 
-                else:
-                    print(f"COULD rename {f} to {renamed_f}\n") 
+            if names.claim(os.path.basename(renamed_f)):
+                names.release(name)
+                plan.add(f, renamed_f)
             else:
                 print(f"CANNOT rename {f} to {renamed_f} because this filename exists already\n")
-        canWill = "can be" if args.dry_run else "were"
-        print(f"Detected {len(files)} files with suffix __XXX -> {renameOk} " + canWill + " renamed safely")
+        canWill = "can be" if args.dry_run else "will be"
+        print(f"Detected {len(files)} files with suffix __XXX -> {len(plan.moves)} " + canWill + " renamed safely")
+        self.executeMovePlan(args, plan)
+
+
+    ###############################################################################################################
+    # Mode 8 - undo the last run of a moving mode
+    #          the executed moves are taken from the journal, so the folder does not have to be scanned
+    def undoLastRun(self, args):
+        run = self.move_journal.lastUndoableRun()
+        if run is None:
+            print("There is no run in the move journal that can be undone.")
+            return
+
+        plan = MovePlan()
+        for index in sorted(run.moved, reverse=True):
+            src, dst = run.plan.moves[index]
+            plan.add(dst, src)
+        # folders created by the run are removed again, folders removed by the run are re-created on demand
+        plan.rmdirs = list(reversed(run.mkdirs))
+        print(f"Undoing run {run.run_id} of mode {run.mode}: {len(plan.moves)} files are moved back")
+        self.executeMovePlan(args, plan, undo_of=run.run_id)
+
+
+    ###############################################################################################################
+    # Mode 9 - ingest new files
+    #          Sorts only the files that were added or changed since the last run into the type subfolders
+    #          (like mode 3) or the monthly subfolders (like mode 5). The first run only records the snapshot.
+    #          With --interval the folder is polled until the program is interrupted.
+    def ingestNewFiles(self, args):
+        folder_path = Path(args.path.rstrip(os.sep))
+        if not self.checkIfDirWithNonReservedName(folder_path):
+            return
+        snapshot = self.tree_snapshot
+        if not snapshot.exists():
+            if args.dry_run:
+                print("DRY_RUN: There is no snapshot yet, the first real run records all current files as known")
+                return
+            inventory = self.getInventory(folder_path, progress=True)
+            snapshot.create(inventory)
+            print(f"Recorded a snapshot of {len(inventory)} files, files added from now on will be ingested")
+            self.inventory = None
+            if args.interval is None:
+                return
+
+        # files seen by the previous poll, only moved if they did not change in between (a sync may still be busy)
+        unstable = {} if args.interval is not None else None
+        try:
+            while True:
+                self.ingestSnapshotDelta(args, folder_path, unstable)
+                if args.interval is None:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            print("Stopped watching for new files")
+
+    def ingestSnapshotDelta(self, args, folder_path, unstable):
+        snapshot = self.tree_snapshot
+        known_dirs, listed_dirs, new_records = self.scanSnapshotDelta(snapshot)
+
+        if unstable is not None:
+            seen_before = unstable.copy()
+            unstable.clear()
+            for record in new_records:
+                if seen_before.get(record.path) != (record.size, record.mtime_ns):
+                    unstable[record.path] = (record.size, record.mtime_ns)
+            new_records = [record for record in new_records if record.path not in unstable]
+        if not new_records and not unstable:
+            if unstable is None:
+                print("No new files")
+            snapshot.commit()
+            return
+
+        print(f"Found {len(new_records)} new files" + (f", {len(unstable)} more are checked again next time" if unstable else ""))
+        plan = MovePlan()
+        if args.ingest_into == 'month':
+            self.planMovesToMonthlySubfolders(args, folder_path, new_records, plan)
+        else:
+            files = {record.name: record for record in new_records if record.dir == str(folder_path)}
+            # twins that arrived in an earlier run are already recorded in the folder or its type subfolders
+            known_names = {subdir_name: set(snapshot.filesIn(os.path.join(folder_path, subdir_name)))
+                           for subdir_name in self.special_folders}
+            twin_names = set(snapshot.filesIn(folder_path)).union(*known_names.values())
+            categories = self.classifyForSubfolders(list(files), twin_names)
+            planned_targets = set()
+            for name, record in files.items():
+                if categories[name] is None:
+                    continue
+                target_path = os.path.join(folder_path, categories[name], name)
+                if target_path in planned_targets or os.path.lexists(target_path):
+                    print(f"CANNOT move {record.path} to subfolder {categories[name]} because this filename exists already")
+                    continue
+                planned_targets.add(target_path)
+                plan.add(record.path, target_path)
+            print(f"{len(plan.moves)} new files are moved into type subfolders")
+            # an original sorted into Pics_and_Movies before its edited version arrived belongs to _Originals now
+            num_new_moves = len(plan.moves)
+            for name in files:
+                if categories[name] != self.dirname_remaining or not re.match(r"^IMG_E[0-9]", name):
+                    continue
+                original = 'IMG_' + name[len('IMG_E'):]
+                if original not in known_names[self.dirname_remaining]:
+                    continue
+                source_path = os.path.join(folder_path, self.dirname_remaining, original)
+                target_path = os.path.join(folder_path, self.dirname_originals, original)
+                if target_path in planned_targets or os.path.lexists(target_path) or not os.path.isfile(source_path):
+                    continue
+                planned_targets.add(target_path)
+                plan.add(source_path, target_path)
+            if len(plan.moves) > num_new_moves:
+                print(f"{len(plan.moves) - num_new_moves} originals of new edited files are moved into {self.dirname_originals}")
+
+        if args.dry_run:
+            self.executeMovePlan(args, plan)
+            snapshot.rollback()
+            return
+
+        # the listed folders are stored before the moves, which then re-key the moved files in the snapshot
+        for dir_path, (mtime_ns, records) in listed_dirs.items():
+            if unstable and any(record.path in unstable for record in records):
+                mtime_ns = None  # list the folder again on the next poll
+                records = [record for record in records if record.path not in unstable]
+            snapshot.storeDir(dir_path, mtime_ns, records)
+
+        target_dirs = {os.path.dirname(dst) for src, dst in plan.moves} - set(listed_dirs)
+        unchanged_dirs = {dir_path for dir_path in target_dirs
+                          if dir_path not in known_dirs or TreeSnapshot.statMtime(dir_path) == known_dirs[dir_path]}
+        self.executeMovePlan(args, plan)
+        # the target folders only changed by our own moves, so they do not have to be listed next time
+        for dir_path in unchanged_dirs:
+            snapshot.storeDirMtime(dir_path, TreeSnapshot.statMtime(dir_path))
+        snapshot.commit()
+
+    # Lists only the folders whose mtime differs from the snapshot (and new folders below them).
+    # Returns ({dir_path: mtime_ns} of the snapshot, {dir_path: (mtime_ns, [FileRecord])} of the listed folders,
+    # [FileRecord] of the new or changed files). Folders that disappeared are dropped from the snapshot.
+    def scanSnapshotDelta(self, snapshot):
+        with self.stats.phase("scan"):
+            known_dirs = snapshot.dirs()
+            self.stats.count("stat_calls", len(known_dirs))
+            changed_dirs = []
+            for dir_path, mtime_ns in known_dirs.items():
+                current_mtime_ns = TreeSnapshot.statMtime(dir_path)
+                if current_mtime_ns is None:
+                    snapshot.removeDir(dir_path)
+                elif current_mtime_ns != mtime_ns:
+                    changed_dirs.append(dir_path)
+
+            listed_dirs = {}
+            new_records = []
+            for dir_path in changed_dirs:
+                # the mtime is taken before listing, so changes during the listing are found next time
+                mtime_ns = TreeSnapshot.statMtime(dir_path)
+                inventory = FileInventory(dir_path, max_depth=0, exclude_dirs=self.excluded_dirs, stats=self.stats)
+                records = list(inventory.filesIn(dir_path).values())
+                listed_dirs[dir_path] = (mtime_ns, records)
+                known_files = snapshot.filesIn(dir_path)
+                new_records += [record for record in records
+                                if known_files.get(record.name) != (record.size, record.mtime_ns)]
+                for subdir in inventory.unscanned_dirs:
+                    if subdir in known_dirs:
+                        continue
+                    # a new folder. Files moved into it by a moving mode are already recorded (TreeSnapshot.move
+                    # re-keys them), all others are new. Its mtime is only recorded when it is listed again
+                    # next time, as it may have changed while the whole new subtree was walked.
+                    subdir_inventory = FileInventory(subdir, exclude_dirs=self.excluded_dirs, stats=self.stats)
+                    for path, files in subdir_inventory.files_by_dir.items():
+                        listed_dirs[path] = (None, list(files.values()))
+                        known_files = snapshot.filesIn(path)
+                        new_records += [record for record in files.values()
+                                        if known_files.get(record.name) != (record.size, record.mtime_ns)]
+        return known_dirs, listed_dirs, new_records
+
+
+    ###############################################################################################################
+    # Mode 10 - find similar images and remove them interactively
+    #           Each image gets a 64 bit difference hash (dHash) of its embedded Exif thumbnail, or of the image
+    #           itself if it has none. Each group is led by its largest image and holds the images whose hashes
+    #           differ from the leader's in at most --max_distance bits; a BK-tree finds the similar hashes, so
+    #           that not every pair of images has to be compared.
+    #           Returns the groups in the form {leader_path: num_occurrences}
+    def findSimilarImages(self, args):
+        try:
+            import numpy  # noqa: F401, used by computeImageHash
+            from PIL import Image as PILImage  # noqa: F401
+        except ImportError:
+            print("Mode 10 needs the packages Pillow and numpy (pip install pillow numpy). Exit.")
+            return {}
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            pass  # HEIC images without Exif thumbnail are skipped
+
+        folder_path = Path(args.path.rstrip(os.sep))
+        records = [record for record in self.getInventory(folder_path, progress=True)
+                   if record.name.lower().endswith(self.image_suffixes) and record.size > 0]
+        image_hashes = self.getImageHashes(records, args.workers)
+        print(f"Hashed {len(image_hashes)} of {len(records)} images")
+
+        with self.stats.phase("grouping"):
+            tree = BKTree()
+            for file_path, image_hash in image_hashes.items():
+                tree.add(image_hash, file_path)
+            # the largest image not grouped yet leads a group of the not yet grouped images similar to it.
+            # Similar pairs are not chained, so that two images of a group never differ by more than twice the
+            # max_distance (and each by at most max_distance from the leader).
+            sizes = {record.path: record.size for record in records}
+            grouped = set()
+            groups = []
+            for leader in sorted(image_hashes, key=lambda file_path: -sizes[file_path]):
+                if leader in grouped:
+                    continue
+                group = [leader] + [file_path for file_path in tree.search(image_hashes[leader], args.max_distance)
+                                    if file_path not in grouped and file_path != leader]
+                grouped.update(group)
+                groups.append(group)
+
+        dup_groups = {paths[0]: paths for paths in groups if len(paths) > 1}
+        dups = {key: len(paths) for key, paths in dup_groups.items()}
+        for key, paths in dup_groups.items():
+            print(f'Similar images: {os.path.basename(key)} -> occurs {len(paths)} times')
+        print(f'Found {len(dups)} groups of similar images')
+        reclaimable = sum(sum(sizes[path] for path in paths) - max(sizes[path] for path in paths)
+                          for paths in dup_groups.values())
+        print(f'{self.formatSize(reclaimable)} could be reclaimed by keeping only the largest image of each group')
+
+        self.resolveDuplicates(args, dups, dup_groups.get, image_hashes=image_hashes)
+        return dups
+
+    # 64 bit image hashes of the given inventory records as {file_path: int}, images that cannot be decoded are
+    # left out. The hashes are cached like the capture timestamps.
+    def getImageHashes(self, records, workers=1):
+        cache = self.metadata_cache
+        hashes = {}
+        missing = []
+        with self.stats.phase("cache"):
+            for record in records:
+                found, image_hash = cache.lookupHash(record.path, record.size, record.mtime_ns) if cache else (False, None)
+                if found:
+                    hashes[record.path] = image_hash
+                else:
+                    missing.append(record)
+
+        with self.stats.phase("image_hashes"):
+            if workers > 1 and len(missing) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    computed = list(pool.map(self.computeImageHash, [record.path for record in missing]))
+            else:
+                computed = [self.computeImageHash(record.path) for record in missing]
+        for record, image_hash in zip(missing, computed):
+            hashes[record.path] = image_hash
+
+        if cache is not None:
+            with self.stats.phase("cache"):
+                for record, image_hash in zip(missing, computed):
+                    if image_hash is None and record.path in self.unreadable_files:
+                        continue  # unknown because the file could not be read, try again next time
+                    cache.storeHash(record.path, record.size, record.mtime_ns, image_hash)
+                cache.commit()
+        return {record.path: int(hashes[record.path], 16) for record in records if hashes[record.path] is not None}
+
+    # dHash of an image as hex string: the image is shrunk to 9x8 gray pixels and each bit tells whether a pixel
+    # is brighter than its left neighbour. The Exif thumbnail is used if there is one, so that the full image
+    # does not have to be decoded; JPEGs without thumbnail are decoded at a reduced scale.
+    def computeImageHash(self, file_path):
+        import numpy
+        from PIL import Image as PILImage
+
+        try:
+            thumbnail = ExifDateReader.readThumbnail(file_path, self.stats)
+        except OSError:
+            self.unreadable_files.add(file_path)
+            return None
+        except ValueError:
+            thumbnail = None
+        try:
+            with PILImage.open(io.BytesIO(thumbnail) if thumbnail else file_path) as image:
+                image.draft('L', (64, 64))
+                pixels = numpy.asarray(image.convert('L').resize((9, 8), PILImage.BILINEAR), dtype=numpy.int16)
+        except Exception:  # Pillow raises all kinds of errors for unsupported or broken files
+            return None
+        return numpy.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+    ###############################################################################################################
+    # Mode 11 - carry out a reviewed deletion plan of mode 2 or 10
+    #           The files are deleted in bulk, or with --quarantine moved into the quarantine folder (keeping their
+    #           relative paths) by a journaled move plan that mode 8 can undo.
+    def applyDeletionPlan(self, args):
+        folder_path = Path(args.path.rstrip(os.sep))
+        plan_path = self.deletionPlanPath(args)
+        if not os.path.isfile(plan_path):
+            print(f"There is no deletion plan {plan_path}. Write one with mode 2 or 10 and --keep_rules. Exit.")
+            return
+
+        deletions = []
+        for keep, delete in self.readDeletionPlan(plan_path):
+            if not delete:
+                continue
+            if not any(os.path.isfile(kept) for kept in keep):
+                print(f"WARNING: Skipping {len(delete)} files of {os.path.basename(delete[0])}, no copy to keep exists anymore")
+                continue
+            deletions += [dup for dup in delete if os.path.isfile(dup)]
+
+        prefix = "DRY_RUN: " if args.dry_run else ""
+        if args.quarantine:
+            quarantine_path = os.path.join(folder_path, self.dirname_quarantine)
+            plan = MovePlan()
+            for dup in deletions:
+                rel_path = os.path.relpath(dup, os.path.abspath(folder_path))
+                if rel_path.startswith(os.pardir):
+                    print(f"ERROR: Cannot move {dup} into quarantine, it is not inside {folder_path}")
+                    continue
+                plan.add(dup, os.path.join(quarantine_path, rel_path))
+            print(prefix + f"Moving {len(plan.moves)} files into {quarantine_path}")
+            self.executeMovePlan(args, plan)
+            return
+
+        num_deleted = 0
+        num_bytes = 0
+        for dup in deletions:
+            if args.dry_run:
+                print(f"DRY_RUN: Delete {dup}")
+                continue
+            try:
+                size = os.path.getsize(dup)
+                os.remove(dup)
+            except OSError as e:
+                print(f"ERROR: Cannot delete {dup}: {e}")
+                continue
+            if args.verbose: print(f"Deleted {dup}")
+            if self.inventory is not None:
+                self.inventory.remove(dup)
+            self.stats.count("files_deleted")
+            num_deleted += 1
+            num_bytes += size
+        if args.dry_run:
+            print(f"DRY_RUN: {len(deletions)} files would be deleted")
+        else:
+            print(f"Deleted {num_deleted} of {len(deletions)} files ({self.formatSize(num_bytes)})")
+
+    # [(keep paths, delete paths)] of the groups of a deletion plan, groups are separated by empty lines
+    @staticmethod
+    def readDeletionPlan(plan_path):
+        groups = []
+        keep, delete = [], []
+        with open(plan_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    if keep or delete:
+                        groups.append((keep, delete))
+                    keep, delete = [], []
+                elif not line.startswith('#'):
+                    action, _, file_path = line.partition('\t')
+                    if action.strip() == 'keep':
+                        keep.append(file_path)
+                    elif action.strip() == 'delete':
+                        delete.append(file_path)
+                    else:
+                        raise ValueError(f"Invalid line in deletion plan {plan_path}: {line}")
+        if keep or delete:
+            groups.append((keep, delete))
+        return groups
 
 
     ###############################################################################################################
     # Helper functions start here
-    def createSubfolderAndMove(self, is_dry_run, is_verbose, parent_folder_path, subdir_name, match_criterion):
+    def planMovesToSubfolder(self, is_dry_run, parent_folder_path, subdir_name, matching_files, plan):
         prefix = "DRY_RUN: " if is_dry_run else ""
 
-        # determine matching files
-        matching_files = []
         print("\n{}".format(subdir_name))
-        for file in os.listdir(parent_folder_path):
-            if os.path.isfile(os.path.join(parent_folder_path, file)):
-                if match_criterion(file, parent_folder_path):
-                    matching_files.append(os.path.join(parent_folder_path, file))
         if not matching_files:
             print(prefix + "No matching files. Directory {} will not be created.".format(subdir_name))
             return
 
-        # create subfolder if matching files
+        # subfolder is created when executing the plan
         subdir_path = os.path.join(parent_folder_path, subdir_name)
         if not os.path.exists(subdir_path):
             print(prefix + "Create new subfolder {}".format(subdir_path))
-            if not is_dry_run: os.makedirs(subdir_path)
         else:
             print("WARNING: The subfolder {} already exists!".format(subdir_path))
 
-        # move matching files to subfolder
         for f in matching_files:
-            if is_verbose: print("  " + prefix + "Moving file {}".format(f))
-            if not is_dry_run: shutil.move(f, subdir_path)
-        print(prefix + "Moved {} files into subfolder".format(len(matching_files)))
+            plan.add(f, os.path.join(subdir_path, os.path.basename(f)))
+        print(prefix + "Moving {} files into subfolder".format(len(matching_files)))
 
 
-    def moveToParentAndDeleteSubfolder(self, is_dry_run, is_verbose, parent_dir, subdir_name):
+    def planMovesToParent(self, is_dry_run, parent_dir, subdir_name, plan):
         prefix = "DRY_RUN: " if is_dry_run else ""
 
         subdir = os.path.join(parent_dir, subdir_name)
@@ -373,60 +1191,343 @@ class PictureMagic(object):
             return
 
         print("\n{}".format(subdir_name))
-        num_moved=0
-        for file in os.listdir(subdir):
-            subdir_file_path = os.path.join(subdir, file)
-            if os.path.isfile(subdir_file_path):
-                if is_verbose: print("  " + prefix + "Moving file {} back to parent folder".format(file))
-                if not is_dry_run: shutil.move(subdir_file_path, parent_dir)
-                num_moved = num_moved + 1
-        print(prefix + "Moved {} files back from subfolder".format(num_moved))
-
-        if len(os.listdir(subdir)) == 0:
+        files = self.getInventory(parent_dir).filesIn(subdir)
+        for file, record in files.items():
+            plan.add(record.path, os.path.join(parent_dir, file))
+        print(prefix + "Moving {} files back from subfolder".format(len(files)))
+
+        # the subfolder is removed after the moves if nothing else is left in it
+        if set(os.listdir(subdir)) == set(files):
             print(prefix + "Removing empty subdir {}".format(subdir))
-            if not is_dry_run: shutil.rmtree(subdir)
+            plan.rmdirs.append(subdir)
         else:
-            if not is_dry_run: print("WARNING: Cannot remove subfolder {} because it is not empty.".format(subdir))
+            print("WARNING: Cannot remove subfolder {} because it is not empty.".format(subdir))
 
-    
-    # TODO: Also use exiftool instead exifread for this
+
+    # Executes the moves of a plan (or only prints them in a dry run). Every started run and every finished
+    # move is written to the move journal, so an interrupted run can be resumed and a run can be undone.
+    # Moves within a device are a plain os.rename, moves to another device are copied (args.workers in parallel),
+    # verified and only then deleted at their source.
+    def executeMovePlan(self, args, plan, undo_of=None):
+        if not plan.moves and not plan.rmdirs:
+            return
+        if args.dry_run:
+            print(f"\nDRY_RUN: Planned {len(plan.moves)} moves:")
+            for src, dst in plan.moves:
+                print(f"DRY_RUN: {src} -> {dst}")
+            for folder in plan.rmdirs:
+                print(f"DRY_RUN: Remove folder {folder} if empty")
+            return
+
+        run_id = self.move_journal.begin(args.mode, plan, undo_of)
+        with self.stats.phase("moves"):
+            self.performMoves(args, run_id, plan, done=set())
+
+    def performMoves(self, args, run_id, plan, done):
+        journal = self.move_journal
+        stats = self.stats
+        same_device = []
+        cross_device = []
+        claimed_targets = set()
+        for index, (src, dst) in enumerate(plan.moves):
+            if index in done:
+                continue
+            if dst in claimed_targets:
+                print(f"ERROR: Cannot move {src} to {dst}, another file is moved there already")
+                continue
+            if not self.prepareMove(run_id, src, dst):
+                continue
+            claimed_targets.add(dst)
+            stats.count("stat_calls", 2)
+            if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+                same_device.append(index)
+            else:
+                cross_device.append(index)
+
+        num_moved = 0
+        for index in same_device:
+            src, dst = plan.moves[index]
+            if args.verbose: print(f"Moving {src} -> {dst}")
+            stats.count("stat_calls")
+            if os.path.lexists(dst):
+                # os.rename would silently replace it
+                print(f"ERROR: Cannot move {src} to {dst}, the target exists already")
+                continue
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                print(f"ERROR: Cannot move {src} to {dst}: {e}")
+                continue
+            journal.log(run_id, "moved", index=index)
+            self.updateAfterMove(src, dst)
+            num_moved += 1
+
+        if cross_device:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                futures = {pool.submit(self.copyVerifyAndDelete, *plan.moves[index]): index for index in cross_device}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    src, dst = plan.moves[index]
+                    try:
+                        future.result()
+                    except OSError as e:
+                        print(f"ERROR: Cannot move {src} to {dst}: {e}")
+                        continue
+                    if args.verbose: print(f"Moved {src} -> {dst} (copied to other device)")
+                    journal.log(run_id, "moved", index=index)
+                    self.updateAfterMove(src, dst)
+                    num_moved += 1
+
+        for folder in plan.rmdirs:
+            try:
+                os.rmdir(folder)
+                journal.log(run_id, "rmdir", path=folder)
+            except OSError:
+                print("WARNING: Cannot remove subfolder {} because it is not empty.".format(folder))
+        journal.end(run_id)
+        print(f"Moved {num_moved} of {len(plan.moves) - len(done)} files" +
+              (f" ({len(cross_device)} copied to another device)" if cross_device else ""))
+
+    # creates the target folder of a move (journaling every created folder), returns False if the move is impossible
+    def prepareMove(self, run_id, src, dst):
+        self.stats.count("stat_calls", 3)
+        if not os.path.isfile(src):
+            print(f"ERROR: Cannot move {src}, it does not exist anymore")
+            return False
+        if os.path.lexists(dst):
+            print(f"ERROR: Cannot move {src} to {dst}, the target exists already")
+            return False
+        missing_dirs = []
+        dst_dir = os.path.dirname(dst)
+        while dst_dir and not os.path.isdir(dst_dir):
+            missing_dirs.append(dst_dir)
+            dst_dir = os.path.dirname(dst_dir)
+            self.stats.count("stat_calls")
+        for folder in reversed(missing_dirs):
+            os.mkdir(folder)
+            self.move_journal.log(run_id, "mkdir", path=folder)
+        return True
+
+    def copyVerifyAndDelete(self, src, dst):
+        self.stats.count("cross_device_copies")
+        partial_dst = dst + ".partial"
+        shutil.copy2(src, partial_dst)
+        if self.hashFile(src, partial=False) != self.hashFile(partial_dst, partial=False):
+            os.remove(partial_dst)
+            raise OSError("the copy differs from the original")
+        os.replace(partial_dst, dst)
+        os.remove(src)
+
+    # finishes a run that was interrupted (e.g. by a crash) before any new plan is made
+    # Returns False if the mode cannot run: a dry run would plan against the tree before the resume, so its
+    # plan would differ from the one of a real run.
+    def resumeInterruptedRun(self, args):
+        run = self.move_journal.lastRun()
+        if run is None or run.ended:
+            return True
+        if args.dry_run:
+            print(f"DRY_RUN: Run {run.run_id} of mode {run.mode} was interrupted. Run without --dry_run to resume it "
+                  "first, the planned operations depend on it. Exit.")
+            return False
+
+        print(f"Resuming interrupted run {run.run_id} of mode {run.mode} ...")
+        done = set(run.moved)
+        for index, (src, dst) in enumerate(run.plan.moves):
+            if index in done:
+                continue
+            if os.path.exists(dst + ".partial"):
+                os.remove(dst + ".partial")
+            if not os.path.lexists(src) and os.path.lexists(dst):
+                done.add(index)  # moved, but not journaled anymore
+            elif os.path.isfile(src) and os.path.isfile(dst) and \
+                    self.hashFile(src, partial=False) == self.hashFile(dst, partial=False):
+                os.remove(src)   # copied to another device, but not deleted at the source anymore
+                done.add(index)
+            else:
+                continue
+            self.move_journal.log(run.run_id, "moved", index=index)
+            self.updateAfterMove(src, dst)
+        with self.stats.phase("moves"):
+            self.performMoves(args, run.run_id, run.plan, done)
+        return True
+
+    # inventory of all files below folder_path (up to max_depth folder levels, None for unlimited)
+    # The inventory is scanned once per run and shared by all steps that need it.
+    def getInventory(self, folder_path, max_depth=None, progress=False):
+        inventory = self.inventory
+        if inventory is None or inventory.root != str(folder_path) or not inventory.covers(max_depth):
+            with self.stats.phase("scan"):
+                inventory = FileInventory(folder_path, max_depth, exclude_dirs=self.excluded_dirs,
+                                          progress_interval=self.progress_interval if progress else None,
+                                          stats=self.stats)
+            self.inventory = inventory
+        return inventory
+
+    @staticmethod
+    def formatSize(num_bytes):
+        for unit in ["bytes", "KB", "MB", "GB"]:
+            if num_bytes < 1024:
+                break
+            num_bytes /= 1024
+        else:
+            unit = "TB"
+        return f"{num_bytes:.1f} {unit}" if unit != "bytes" else f"{num_bytes} {unit}"
+
+    # keeps the inventory and the metadata cache entry of a moved file up to date,
+    # so the file is neither scanned nor parsed again at its new location
+    def updateAfterMove(self, src, dst):
+        self.stats.count("moves")
+        if self.inventory is not None:
+            self.inventory.move(str(src), str(dst))
+        if self.metadata_cache is not None:
+            self.metadata_cache.rename(src, dst)
+        if self.tree_snapshot is not None:
+            self.tree_snapshot.move(src, dst)
+
+    # content hash of a file, either of its first and last partial_hash_size bytes or of the complete file
+    def hashFile(self, file_path, partial):
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            if partial:
+                content_hash.update(f.read(self.partial_hash_size))
+                if os.fstat(f.fileno()).st_size > 2 * self.partial_hash_size:
+                    f.seek(-self.partial_hash_size, os.SEEK_END)
+                content_hash.update(f.read(self.partial_hash_size))
+            else:
+                buffer = bytearray(self.full_hash_buffer_size)
+                view = memoryview(buffer)
+                while True:
+                    num_read = f.readinto(buffer)
+                    if not num_read:
+                        break
+                    content_hash.update(view[:num_read])
+        return content_hash.hexdigest()
+
+    # capture timestamps of all given inventory records, returns {file_path: timestamp or None} in their order
+    # Files whose path, size and mtime are unchanged since the last run are answered from the metadata cache.
+    def getCaptureTimestamps(self, records, workers=1):
+        cache = self.metadata_cache
+        if cache is None:
+            return self.extractCaptureTimestamps([record.path for record in records], workers)
+
+        timestamps = {}
+        missing = []
+        with self.stats.phase("cache"):
+            for record in records:
+                if not record.name.lower().endswith(self.image_suffixes + self.video_suffixes):
+                    continue
+                found, dt = cache.lookup(record.path, record.size, record.mtime_ns)
+                if found:
+                    timestamps[record.path] = dt
+                else:
+                    missing.append(record)
+
+        extracted = self.extractCaptureTimestamps([record.path for record in missing], workers)
+        with self.stats.phase("cache"):
+            for record in missing:
+                dt = extracted[record.path]
+                timestamps[record.path] = dt
+                if dt is None and self.exiftool_unavailable and record.name.lower().endswith(self.video_suffixes):
+                    continue  # unknown because exiftool is missing, not because the video has no date
+                if dt is None and record.path in self.unreadable_files:
+                    continue  # unknown because the file could not be read, try again next time
+                cache.store(record.path, record.size, record.mtime_ns, dt)
+            cache.commit()
+        return {record.path: timestamps.get(record.path) for record in records}
+
+    # capture timestamps of all given files, returns {file_path: timestamp or None} in the order of file_paths
+    # videos are looked up in batches, so that exiftool is not started once per file.
+    # With more than one worker the lookups run on a thread pool: they mostly wait for the disk (or exiftool),
+    # so threads overlap that latency without the cost of pickling paths and results between processes.
+    def extractCaptureTimestamps(self, file_paths, workers=1):
+        with self.stats.phase("metadata"):
+            videos = [file_path for file_path in file_paths if str(file_path).lower().endswith(self.video_suffixes)]
+            images = [file_path for file_path in file_paths if str(file_path).lower().endswith(self.image_suffixes)]
+
+            if workers > 1 and len(images) + len(videos) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    image_results = pool.map(self.getImageCaptureTimestamp, images)
+                    video_timestamps = self.getVideoCaptureTimestamps(videos, pool)
+                    image_timestamps = dict(zip(images, image_results))
+            else:
+                video_timestamps = self.getVideoCaptureTimestamps(videos)
+                image_timestamps = {file_path: self.getImageCaptureTimestamp(file_path) for file_path in images}
+
+        timestamps = {}
+        for file_path in file_paths:
+            dt = None
+            lower_name = str(file_path).lower()
+            if lower_name.endswith(self.image_suffixes):
+                dt = image_timestamps[file_path]
+            elif lower_name.endswith(self.video_suffixes):
+                dt = video_timestamps[file_path]
+            timestamps[file_path] = dt
+        return timestamps
+
+
+    # DateTimeOriginal of an image, read from its Exif segment only (see ExifDateReader).
+    # Files whose structure the fast reader does not understand are parsed completely by exifread.
     def getImageCaptureTimestamp(self, file_path):
         try:
-            f = open(file_path, 'rb')
-            tags = exifread.process_file(f)
-            if not tags:
-                Exception("no exif found!")
-            dt = str(tags['EXIF DateTimeOriginal'])
-            return dt
+            return ExifDateReader.read(file_path, self.stats)[0]
+        except OSError:
+            self.unreadable_files.add(file_path)
+            return None
+        except ValueError:
+            pass
+
+        try:
+            import exifread
+            with IsoBoxReader.openFile(file_path, self.stats) as f:
+                tags = exifread.process_file(f, details=False)
+            return str(tags['EXIF DateTimeOriginal'])
+        except OSError:
+            self.unreadable_files.add(file_path)
+            return None
         except:
             return None
-        finally:
-            f.close()
 
 
-    # capture date of MOV from its stored meta-data (platform specific)
+    # capture date of a MOV/MP4 from its stored meta-data
     def getVideoCaptureTimestamp(self, file_path):
-        current_platform = platform.system()
-        if current_platform == 'Windows':
-            return self.getVideoCaptureTimestampWindows(file_path)
-        elif current_platform == 'Linux':
-            return self.getVideoCaptureTimestampLinux(file_path)
-        else:
-            print(f"Unknown platform: {current_platform}")
+        return self.getVideoCaptureTimestamps([file_path])[file_path]
+
+    # capture dates of many videos at once, returns {file_path: timestamp or None}
+    # The moov atom of each video is parsed in-process (on the given thread pool, if any). Only videos the parser
+    # does not understand are handed to the platform specific fallback: win32com on Windows, exiftool elsewhere.
+    def getVideoCaptureTimestamps(self, file_paths, pool=None):
+        results = pool.map(self.parseVideoCaptureTimestamp, file_paths) if pool else map(self.parseVideoCaptureTimestamp, file_paths)
+        timestamps = {}
+        failed = []
+        for file_path, (parsed, dt) in zip(file_paths, results):
+            timestamps[file_path] = dt
+            if not parsed:
+                failed.append(file_path)
+
+        if failed:
+            if platform.system() == 'Windows':
+                timestamps.update({file_path: self.getVideoCaptureTimestampWindows(file_path) for file_path in failed})
+            else:
+                timestamps.update(self.getVideoCaptureTimestampsExifTool(failed))
+        return timestamps
+
+    # returns (True, timestamp or None) if the QuickTime atoms could be parsed, (False, None) otherwise
+    def parseVideoCaptureTimestamp(self, file_path):
+        try:
+            return True, QuickTimeDateReader.read(file_path, self.stats)
+        except OSError:
+            self.unreadable_files.add(file_path)
+            return False, None
+        except ValueError:
+            return False, None
 
     def getVideoCaptureTimestampWindows(self, file_path):
         try:
-            try: 
-                import win32com
-                print("win32com was already installed")
-            except ImportError:
-                from pip._internal import main as pip
-                pip(['install', '--user', 'win32com'])
-                import win32com
-                print("Installed and imported win32com")
-
-            properties = win32com.propsys.SHGetPropertyStoreFromParsingName(file_path)
-            dt = properties.GetValue(win32com.pscon.PKEY_Media_DateEncoded).GetValue()
+            from win32com.propsys import propsys, pscon
+            import pytz
+
+            properties = propsys.SHGetPropertyStoreFromParsingName(str(file_path))
+            dt = properties.GetValue(pscon.PKEY_Media_DateEncoded).GetValue()
 
             if not isinstance(dt, datetime.datetime):
                 # In Python 2, PyWin32 returns a custom time type instead of
@@ -440,14 +1541,58 @@ class PictureMagic(object):
         except:
             return None
 
-    def getVideoCaptureTimestampLinux(self, file_path):
+    def getVideoCaptureTimestampsExifTool(self, file_paths):
+        if not file_paths:
+            return {}
+        try:
+            self.getExifToolSession()
+        except:
+            print("WARNING: exiftool could not be started, video capture timestamps are unknown")
+            self.exiftool_unavailable = True
+            return {file_path: None for file_path in file_paths}
+
+        timestamps = {}
+        with self.stats.phase("exiftool"):
+            for start in range(0, len(file_paths), self.exiftool_batch_size):
+                batch = file_paths[start:start+self.exiftool_batch_size]
+                timestamps.update(self.getVideoCaptureTimestampsBatch(batch))
+        return timestamps
+
+    def getVideoCaptureTimestampsBatch(self, file_paths):
         try:
-            with exiftool.ExifToolHelper() as et:
-                metadata = et.get_metadata(file_path)
-                dt = metadata[0]["QuickTime:CreationDate"]
-                return dt
+            metadata = self.getExifToolSession().get_metadata([str(file_path) for file_path in file_paths])
         except:
-            return None            
+            if len(file_paths) == 1:
+                return {file_paths[0]: None}
+            # a single corrupt file fails the whole call -> split the batch until it is isolated
+            half = len(file_paths) // 2
+            timestamps = self.getVideoCaptureTimestampsBatch(file_paths[:half])
+            timestamps.update(self.getVideoCaptureTimestampsBatch(file_paths[half:]))
+            return timestamps
+
+        # exiftool skips unreadable files in its output, so match the results by SourceFile instead of by index
+        metadata_by_path = {os.path.normpath(m.get("SourceFile", "")): m for m in metadata}
+        return {file_path: metadata_by_path.get(os.path.normpath(str(file_path)), {}).get("QuickTime:CreationDate")
+                for file_path in file_paths}
+
+    def getExifToolSession(self):
+        if self.exiftool_session is not None and not self.exiftool_session.running:
+            # exiftool died while processing a broken file -> start a fresh one
+            self.closeExifToolSession()
+        if self.exiftool_session is None:
+            import exiftool
+            self.exiftool_session = exiftool.ExifToolHelper()
+            self.stats.count("subprocesses_started")
+            self.exiftool_session.run()
+        return self.exiftool_session
+
+    def closeExifToolSession(self):
+        if self.exiftool_session is not None:
+            try:
+                self.exiftool_session.terminate()
+            except:
+                pass
+            self.exiftool_session = None
 
     def checkIfDirWithNonReservedName(self, folder_path):
 
@@ -468,6 +1613,1057 @@ class PictureMagic(object):
 
 
 
+###############################################################################################################
+# Walks the boxes (atoms) of ISO base media files (HEIC, MOV, MP4) by their headers
+class IsoBoxReader(object):
+
+    # opens a file for binary reading, the bytes actually read from it are counted in the given (enabled) RunStats
+    @staticmethod
+    def openFile(file_path, stats=None):
+        if stats is None or not stats.enabled:
+            return open(file_path, 'rb')
+        return io.BufferedReader(CountingFileIO(file_path, stats))
+
+    # (type, payload offset, payload size) of the boxes in a file region, reading only the box headers
+    @staticmethod
+    def iterBoxes(f, start, end):
+        offset = start
+        while end is None or offset + 8 <= end:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size, box_type = struct.unpack('>I4s', header)
+            header_size = 8
+            if size == 1:
+                large_size = f.read(8)
+                if len(large_size) < 8:
+                    raise ValueError("truncated box header")
+                size = struct.unpack('>Q', large_size)[0]
+                header_size = 16
+            elif size == 0:
+                size = os.fstat(f.fileno()).st_size - offset
+            if size < header_size:
+                raise ValueError("broken box size")
+            yield box_type, offset + header_size, size - header_size
+            offset += size
+
+    # same as iterBoxes, for boxes already read into memory
+    @staticmethod
+    def iterBufferBoxes(data, start):
+        offset = start
+        while offset + 8 <= len(data):
+            size, box_type = struct.unpack_from('>I4s', data, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', data, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = len(data) - offset
+            if size < header_size:
+                raise ValueError("broken box size")
+            yield box_type, offset + header_size, size - header_size
+            offset += size
+
+
+###############################################################################################################
+# Unbuffered file that counts the bytes read from it as metadata_bytes_read
+class CountingFileIO(io.FileIO):
+
+    def __init__(self, file_path, stats):
+        super().__init__(file_path, 'rb')
+        self.stats = stats
+
+    def readinto(self, buffer):
+        num_read = super().readinto(buffer)
+        if num_read:
+            self.stats.count("metadata_bytes_read", num_read)
+        return num_read
+
+
+###############################################################################################################
+# Reads DateTimeOriginal and OffsetTimeOriginal of an image with as few bytes as possible:
+# only the Exif block is read (APP1 segment of a JPEG, "Exif" item of the HEIC meta box, eXIf chunk of a PNG),
+# everything in front of it is skipped with seeks. read() returns (datetime, offset), both None if the image
+# has no such tags, and raises ValueError if the file structure is not understood.
+# readThumbnail() returns the JPEG thumbnail stored in the same block (IFD1), if there is one.
+class ExifDateReader(IsoBoxReader):
+
+    max_exif_size = 256 * 1024
+    max_meta_box_size = 4 * 1024 * 1024
+
+    tag_exif_ifd = 0x8769
+    tag_datetime_original = 0x9003
+    tag_offset_time_original = 0x9011
+    tag_thumbnail_offset = 0x0201
+    tag_thumbnail_length = 0x0202
+
+    @classmethod
+    def read(cls, file_path, stats=None):
+        tiff = cls.readTiff(file_path, stats)
+        if tiff is None:
+            return None, None
+        return cls.parseTiff(tiff)
+
+    # the embedded JPEG thumbnail (IFD1) of an image, None if it has none
+    @classmethod
+    def readThumbnail(cls, file_path, stats=None):
+        tiff = cls.readTiff(file_path, stats)
+        if tiff is None:
+            return None
+        byte_order = cls.byteOrder(tiff)
+        try:
+            ifd0_offset = struct.unpack_from(byte_order + 'I', tiff, 4)[0]
+            num_entries = struct.unpack_from(byte_order + 'H', tiff, ifd0_offset)[0]
+            ifd1_offset = struct.unpack_from(byte_order + 'I', tiff, ifd0_offset + 2 + 12 * num_entries)[0]
+            if ifd1_offset == 0:
+                return None
+            ifd1 = cls.readIfd(tiff, byte_order, ifd1_offset)
+            offset = cls.readValue(tiff, byte_order, ifd1.get(cls.tag_thumbnail_offset))
+            length = cls.readValue(tiff, byte_order, ifd1.get(cls.tag_thumbnail_length))
+        except struct.error:
+            raise ValueError("truncated TIFF structure")
+        if not offset or not length or offset + length > len(tiff):
+            return None
+        return tiff[offset:offset + length]
+
+    # the TIFF structure of the Exif block of an image, None if it has none
+    @classmethod
+    def readTiff(cls, file_path, stats=None):
+        with cls.openFile(file_path, stats) as f:
+            header = f.read(12)
+            f.seek(0)
+            try:
+                if header.startswith(b'\xff\xd8'):
+                    tiff = cls.findJpegExif(f)
+                elif header.startswith(b'\x89PNG\r\n\x1a\n'):
+                    tiff = cls.findPngExif(f)
+                elif header[4:8] == b'ftyp':
+                    tiff = cls.findHeifExif(f)
+                else:
+                    raise ValueError("unknown image format")
+            except struct.error:
+                # a length or offset field is cut off
+                raise ValueError("truncated image file")
+        return tiff
+
+    @classmethod
+    def findJpegExif(cls, f):
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                raise ValueError("broken JPEG segment")
+            if marker[1] in (0xDA, 0xD9):
+                return None  # image data starts, there is no Exif segment in front of it
+            length = struct.unpack('>H', f.read(2))[0]
+            if marker[1] == 0xE1:
+                data = f.read(length - 2)
+                if data.startswith(b'Exif\x00\x00'):
+                    return data[6:]
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+    @classmethod
+    def findPngExif(cls, f):
+        f.seek(8)
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            length, chunk_type = struct.unpack('>I4s', chunk_header)
+            if chunk_type == b'eXIf':
+                data = f.read(min(length, cls.max_exif_size))
+                return data[6:] if data.startswith(b'Exif\x00\x00') else data
+            if chunk_type == b'IEND':
+                return None
+            f.seek(length + 4, os.SEEK_CUR)  # data and CRC
+
+    @classmethod
+    def findHeifExif(cls, f):
+        meta = None
+        for box_type, payload_offset, payload_size in cls.iterBoxes(f, 0, None):
+            if box_type == b'meta':
+                if payload_size > cls.max_meta_box_size:
+                    raise ValueError("meta box too large")
+                f.seek(payload_offset)
+                meta = f.read(payload_size)
+                break
+        if meta is None:
+            raise ValueError("no meta box")
+
+        # meta is a full box: skip version and flags
+        children = {box_type: meta[start:start + size] for box_type, start, size in cls.iterBufferBoxes(meta, 4)}
+        exif_item_id = cls.findHeifItem(children.get(b'iinf', b''), b'Exif')
+        if exif_item_id is None:
+            return None
+        location = cls.findHeifItemLocation(children.get(b'iloc', b''), exif_item_id)
+        if location is None:
+            raise ValueError("Exif item without location")
+        offset, length = location
+        f.seek(offset)
+        data = f.read(min(length, cls.max_exif_size))
+        # the item starts with the offset of the TIFF header behind this field (usually after "Exif\0\0")
+        tiff_offset = 4 + struct.unpack('>I', data[:4])[0]
+        return data[tiff_offset:]
+
+    # item ID of the first item of the given type in an iinf box
+    @classmethod
+    def findHeifItem(cls, iinf, item_type):
+        if len(iinf) < 6:
+            return None
+        version = iinf[0]
+        start = 6 if version == 0 else 8
+        for box_type, offset, size in cls.iterBufferBoxes(iinf, start):
+            if box_type != b'infe' or size < 4:
+                continue
+            infe_version = iinf[offset]
+            if infe_version == 2 and iinf[offset + 8:offset + 12] == item_type:
+                return struct.unpack_from('>H', iinf, offset + 4)[0]
+            if infe_version == 3 and iinf[offset + 10:offset + 14] == item_type:
+                return struct.unpack_from('>I', iinf, offset + 4)[0]
+        return None
+
+    # (file offset, length) of the first extent of an item in an iloc box
+    @staticmethod
+    def findHeifItemLocation(iloc, item_id):
+        def readUInt(offset, size):
+            return int.from_bytes(iloc[offset:offset + size], 'big') if size else 0
+
+        if len(iloc) < 8:
+            return None
+        version = iloc[0]
+        offset_size, length_size = iloc[4] >> 4, iloc[4] & 0x0F
+        base_offset_size, index_size = iloc[5] >> 4, (iloc[5] & 0x0F) if version in (1, 2) else 0
+        id_size = 4 if version == 2 else 2
+        item_count = readUInt(6, id_size)
+        pos = 6 + id_size
+        for _ in range(item_count):
+            current_id = readUInt(pos, id_size)
+            pos += id_size
+            if version in (1, 2):
+                pos += 2  # reserved and construction_method
+            pos += 2      # data_reference_index
+            base_offset = readUInt(pos, base_offset_size)
+            pos += base_offset_size
+            extent_count = readUInt(pos, 2)
+            pos += 2
+            extents = []
+            for _ in range(extent_count):
+                pos += index_size
+                extent_offset = readUInt(pos, offset_size)
+                pos += offset_size
+                extent_length = readUInt(pos, length_size)
+                pos += length_size
+                extents.append((base_offset + extent_offset, extent_length))
+            if current_id == item_id:
+                return extents[0] if extents else None
+        return None
+
+    # (DateTimeOriginal, OffsetTimeOriginal) from the Exif sub-IFD of a TIFF structure
+    @classmethod
+    def parseTiff(cls, tiff):
+        byte_order = cls.byteOrder(tiff)
+        try:
+            ifd0_offset = struct.unpack_from(byte_order + 'I', tiff, 4)[0]
+            ifd0 = cls.readIfd(tiff, byte_order, ifd0_offset)
+            if cls.tag_exif_ifd not in ifd0:
+                return None, None
+            exif_ifd = cls.readIfd(tiff, byte_order, cls.readValue(tiff, byte_order, ifd0[cls.tag_exif_ifd]))
+            return (cls.readValue(tiff, byte_order, exif_ifd.get(cls.tag_datetime_original)),
+                    cls.readValue(tiff, byte_order, exif_ifd.get(cls.tag_offset_time_original)))
+        except struct.error:
+            raise ValueError("truncated TIFF structure")
+
+    @staticmethod
+    def byteOrder(tiff):
+        if tiff[:2] == b'II':
+            return '<'
+        if tiff[:2] == b'MM':
+            return '>'
+        raise ValueError("no TIFF header")
+
+    # {tag: (type, count, raw value/offset field)} of one IFD
+    @staticmethod
+    def readIfd(tiff, byte_order, offset):
+        num_entries = struct.unpack_from(byte_order + 'H', tiff, offset)[0]
+        entries = {}
+        for i in range(num_entries):
+            tag, value_type, count = struct.unpack_from(byte_order + 'HHI', tiff, offset + 2 + 12 * i)
+            entries[tag] = (value_type, count, tiff[offset + 10 + 12 * i:offset + 14 + 12 * i])
+        return entries
+
+    # value of an IFD entry with type ASCII (2) or LONG (4)
+    @staticmethod
+    def readValue(tiff, byte_order, entry):
+        if entry is None:
+            return None
+        value_type, count, field = entry
+        if value_type == 4:
+            return struct.unpack(byte_order + 'I', field)[0]
+        if value_type != 2:
+            return None
+        if count <= 4:
+            raw = field[:count]
+        else:
+            offset = struct.unpack(byte_order + 'I', field)[0]
+            raw = tiff[offset:offset + count]
+        return raw.split(b'\x00', 1)[0].decode('ascii', errors='replace').strip() or None
+
+
+###############################################################################################################
+# Reads the creation date of a QuickTime/MP4 video from its moov atom, seeking over everything else (e.g. the
+# media data). Apple's "com.apple.quicktime.creationdate" (local time with time zone) is preferred, the UTC
+# creation_time of the mvhd atom is used otherwise. read() returns the date in exiftool's format
+# ("2023:05:12 14:03:22+02:00"), None if the video has no date, and raises ValueError for unknown files.
+class QuickTimeDateReader(IsoBoxReader):
+
+    max_meta_size = 1024 * 1024
+    creation_date_key = b'com.apple.quicktime.creationdate'
+    mac_epoch = datetime.datetime(1904, 1, 1)
+
+    @classmethod
+    def read(cls, file_path, stats=None):
+        with cls.openFile(file_path, stats) as f:
+            header = f.read(8)
+            if len(header) < 8 or header[4:8] not in (b'ftyp', b'wide', b'free', b'mdat', b'moov', b'skip', b'pnot'):
+                raise ValueError("no QuickTime file")
+            moov = None
+            for box_type, offset, size in cls.iterBoxes(f, 0, None):
+                if box_type == b'moov':
+                    moov = (offset, size)
+                    break
+            if moov is None:
+                raise ValueError("no moov atom")
+
+            creation_time = None
+            creation_date = None
+            try:
+                for box_type, offset, size in cls.iterBoxes(f, moov[0], moov[0] + moov[1]):
+                    if box_type == b'mvhd':
+                        f.seek(offset)
+                        creation_time = cls.parseMvhd(f.read(min(size, 32)))
+                    elif box_type == b'meta' and size <= cls.max_meta_size:
+                        f.seek(offset)
+                        creation_date = cls.parseMeta(f.read(size))
+            except struct.error:
+                # an atom is shorter than its fields, let exiftool have a look
+                raise ValueError("truncated QuickTime atom")
+        return creation_date or creation_time
+
+    @classmethod
+    def parseMvhd(cls, mvhd):
+        if mvhd[:1] == b'\x01':
+            seconds = struct.unpack_from('>Q', mvhd, 4)[0]
+        else:
+            seconds = struct.unpack_from('>I', mvhd, 4)[0]
+        if seconds == 0:
+            return None
+        return (cls.mac_epoch + datetime.timedelta(seconds=seconds)).strftime("%Y:%m:%d %H:%M:%S")
+
+    # value of the creation date key in a QuickTime meta atom (keys + ilst)
+    @classmethod
+    def parseMeta(cls, meta):
+        # the QuickTime meta atom has no version/flags, the ISO one has, both start with a hdlr atom
+        start = 4 if meta[8:12] == b'hdlr' else 0
+        children = {box_type: meta[offset:offset + size] for box_type, offset, size in cls.iterBufferBoxes(meta, start)}
+        keys = children.get(b'keys', b'')
+        key_index = None
+        pos = 8  # version/flags and entry count
+        index = 1
+        while pos + 8 <= len(keys):
+            key_size = struct.unpack_from('>I', keys, pos)[0]
+            if key_size < 8:
+                break
+            if keys[pos + 8:pos + key_size] == cls.creation_date_key:
+                key_index = index
+                break
+            pos += key_size
+            index += 1
+        if key_index is None:
+            return None
+
+        ilst = children.get(b'ilst', b'')
+        for box_type, offset, size in cls.iterBufferBoxes(ilst, 0):
+            if struct.unpack('>I', box_type)[0] != key_index:
+                continue
+            for data_type, data_offset, data_size in cls.iterBufferBoxes(ilst[offset:offset + size], 0):
+                if data_type == b'data' and data_size > 8:
+                    value = ilst[offset + data_offset + 8:offset + data_offset + data_size]
+                    return cls.formatCreationDate(value.decode('utf-8', errors='replace'))
+        return None
+
+    # "2023-05-12T14:03:22+0200" -> "2023:05:12 14:03:22+02:00"
+    @staticmethod
+    def formatCreationDate(value):
+        match = re.match(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?", value)
+        if not match:
+            return None
+        date = ":".join(match.group(1, 2, 3)) + " " + ":".join(match.group(4, 5, 6))
+        zone = match.group(7)
+        if zone == "Z":
+            zone = "+00:00"
+        elif zone and ":" not in zone:
+            zone = zone[:3] + ":" + zone[3:]
+        return date + (zone or "")
+
+
+###############################################################################################################
+# Compact record of a scanned file, the stat result is taken once during the scan
+class FileRecord(collections.namedtuple("FileRecord", ["name", "dir", "suffix", "size", "mtime_ns"])):
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.name)
+
+
+###############################################################################################################
+# All files below a folder, collected in a single os.scandir walk.
+# Files are stored per directory ({dir: {name: FileRecord}}); the indexes by suffix and by name are built on
+# first use and dropped whenever a file is moved. Folders named in exclude_dirs are skipped on every level.
+class FileInventory(object):
+
+    def __init__(self, root, max_depth=None, exclude_dirs=(), progress_interval=None, stats=None):
+        self.root = str(root)
+        self.max_depth = max_depth
+        self.exclude_dirs = set(exclude_dirs)
+        self.files_by_dir = {}
+        self.unscanned_dirs = []   # folders below max_depth, which were not walked
+        self.by_suffix = None
+        self.by_name = None
+        num_scanned = self.scan(progress_interval)
+        if stats is not None:
+            # one stat() per file, the file types come from the directory listing
+            stats.count("files_scanned", num_scanned)
+            stats.count("stat_calls", num_scanned)
+
+    def scan(self, progress_interval):
+        num_scanned = 0
+        pending = [(self.root, 0)]
+        while pending:
+            dir_path, depth = pending.pop()
+            files = self.files_by_dir.setdefault(dir_path, {})
+            subdirs = []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name in self.exclude_dirs:
+                                continue
+                            if self.max_depth is None or depth < self.max_depth:
+                                subdirs.append(entry.path)
+                            else:
+                                self.unscanned_dirs.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files[entry.name] = FileRecord(entry.name, dir_path, os.path.splitext(entry.name)[1],
+                                                           stat.st_size, stat.st_mtime_ns)
+                            num_scanned += 1
+                            if progress_interval and num_scanned % progress_interval == 0:
+                                print(f"Scanned {num_scanned} files ...")
+            except OSError as e:
+                print(f"WARNING: Cannot read folder {dir_path}: {e}")
+            # reversed, so that the subfolders are walked in listing order
+            pending.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+        return num_scanned
+
+    # True if this inventory contains all files up to the given depth
+    def covers(self, max_depth):
+        return self.max_depth is None or (max_depth is not None and max_depth <= self.max_depth)
+
+    def __iter__(self):
+        for files in self.files_by_dir.values():
+            yield from files.values()
+
+    def __len__(self):
+        return sum(len(files) for files in self.files_by_dir.values())
+
+    # {name: FileRecord} of the files directly in dir_path
+    def filesIn(self, dir_path):
+        return self.files_by_dir.get(str(dir_path), {})
+
+    def get(self, file_path):
+        return self.filesIn(os.path.dirname(file_path)).get(os.path.basename(file_path))
+
+    # {suffix: [FileRecord]}, suffixes are case-sensitive and '' for files without suffix
+    def bySuffix(self):
+        if self.by_suffix is None:
+            self.by_suffix = collections.defaultdict(list)
+            for record in self:
+                self.by_suffix[record.suffix].append(record)
+        return self.by_suffix
+
+    # {name: [FileRecord]}
+    def byName(self):
+        if self.by_name is None:
+            self.by_name = collections.defaultdict(list)
+            for record in self:
+                self.by_name[record.name].append(record)
+        return self.by_name
+
+    def move(self, src, dst):
+        record = self.filesIn(os.path.dirname(src)).pop(os.path.basename(src), None)
+        if record is None:
+            return
+        dst_dir, dst_name = os.path.split(dst)
+        if dst_dir in self.files_by_dir or self.isCovered(dst_dir):
+            self.files_by_dir.setdefault(dst_dir, {})[dst_name] = record._replace(name=dst_name, dir=dst_dir,
+                                                                                 suffix=os.path.splitext(dst_name)[1])
+        self.by_suffix = None
+        self.by_name = None
+
+    def remove(self, file_path):
+        if self.filesIn(os.path.dirname(file_path)).pop(os.path.basename(file_path), None) is not None:
+            self.by_suffix = None
+            self.by_name = None
+
+    # True if a (possibly new) folder lies within the scanned part of the tree
+    def isCovered(self, dir_path):
+        rel_path = os.path.relpath(dir_path, self.root)
+        if rel_path == os.curdir:
+            return True
+        if rel_path.startswith(os.pardir):
+            return False
+        parts = rel_path.split(os.sep)
+        return not self.exclude_dirs.intersection(parts) and (self.max_depth is None or len(parts) <= self.max_depth)
+
+
+###############################################################################################################
+# Persistent cache of extracted capture timestamps (and of the image hashes of mode 10), stored as SQLite
+# database in the state folder. Entries are keyed by the path relative to the library folder and are only valid
+# as long as size and mtime of the file are unchanged. Moving a file within the library re-keys its entry
+# instead of dropping it.
+class MetadataCache(object):
+
+    filename = "metadata_cache.sqlite"
+
+    def __init__(self, library_path, state_path, rebuild=False):
+        self.library_path = os.path.abspath(library_path)
+        self.db_path = os.path.join(state_path, self.filename)
+        self.rebuild = rebuild
+        self.connection = None
+        self.unavailable = False  # the cache cannot be opened or written, the run continues as with --no_cache
+        self.entries = None  # {relative path: (size, mtime_ns, timestamp)}, loaded on first lookup
+        self.hash_entries = None  # {relative path: (size, mtime_ns, image hash)}, loaded on first lookupHash
+
+    # returns None if the cache does not exist (and create is False) or cannot be opened
+    def connect(self, create=True):
+        if self.connection is None:
+            if self.unavailable or (not create and not os.path.isfile(self.db_path)):
+                return None
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                self.connection = sqlite3.connect(self.db_path)
+                self.connection.execute("CREATE TABLE IF NOT EXISTS files "
+                                        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, timestamp TEXT)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS hashes "
+                                        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+                if self.rebuild:
+                    print("Rebuilding the metadata cache")
+                    self.connection.execute("DELETE FROM files")
+                    self.connection.execute("DELETE FROM hashes")
+                    self.rebuild = False
+            except (OSError, sqlite3.Error) as e:
+                self.disable(e)
+        return self.connection
+
+    # e.g. on a read-only mount or if a file is in the way of the state folder
+    def disable(self, error):
+        print(f"WARNING: The metadata cache {self.db_path} cannot be used ({error}), continuing without it")
+        self.unavailable = True
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def relativePath(self, file_path):
+        rel_path = os.path.relpath(os.path.abspath(file_path), self.library_path)
+        return None if rel_path.startswith(os.pardir) else rel_path
+
+    # returns (True, timestamp) for a valid entry, (False, None) if the file has to be parsed
+    def lookup(self, file_path, size, mtime_ns):
+        if self.entries is None:
+            connection = self.connect()
+            rows = connection.execute("SELECT path, size, mtime_ns, timestamp FROM files") if connection else []
+            self.entries = {row[0]: row[1:] for row in rows}
+        entry = self.entries.get(self.relativePath(file_path))
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            return True, entry[2]
+        return False, None
+
+    def store(self, file_path, size, mtime_ns, timestamp):
+        rel_path = self.relativePath(file_path)
+        connection = self.connect()
+        if rel_path is None or connection is None:
+            return
+        try:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (rel_path, size, mtime_ns, timestamp))
+        except sqlite3.Error as e:
+            self.disable(e)
+            return
+        if self.entries is not None:
+            self.entries[rel_path] = (size, mtime_ns, timestamp)
+
+    # returns (True, image hash as hex string or None) for a valid entry, (False, None) if the file has to be hashed
+    def lookupHash(self, file_path, size, mtime_ns):
+        if self.hash_entries is None:
+            connection = self.connect()
+            rows = connection.execute("SELECT path, size, mtime_ns, hash FROM hashes") if connection else []
+            self.hash_entries = {row[0]: row[1:] for row in rows}
+        entry = self.hash_entries.get(self.relativePath(file_path))
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            return True, entry[2]
+        return False, None
+
+    def storeHash(self, file_path, size, mtime_ns, image_hash):
+        rel_path = self.relativePath(file_path)
+        connection = self.connect()
+        if rel_path is None or connection is None:
+            return
+        try:
+            connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", (rel_path, size, mtime_ns, image_hash))
+        except sqlite3.Error as e:
+            self.disable(e)
+            return
+        if self.hash_entries is not None:
+            self.hash_entries[rel_path] = (size, mtime_ns, image_hash)
+
+    def rename(self, old_path, new_path):
+        connection = self.connect(create=False)
+        old_rel_path = self.relativePath(old_path)
+        if connection is None or old_rel_path is None:
+            return
+        new_rel_path = self.relativePath(new_path)
+        for table, entries in (("files", self.entries), ("hashes", self.hash_entries)):
+            try:
+                if new_rel_path is None:
+                    connection.execute(f"DELETE FROM {table} WHERE path = ?", (old_rel_path,))
+                else:
+                    connection.execute(f"UPDATE OR REPLACE {table} SET path = ? WHERE path = ?", (new_rel_path, old_rel_path))
+            except sqlite3.Error as e:
+                self.disable(e)
+                return
+            if entries is not None:
+                entry = entries.pop(old_rel_path, None)
+                if entry is not None and new_rel_path is not None:
+                    entries[new_rel_path] = entry
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+###############################################################################################################
+# Snapshot of the folder tree for incremental ingests (mode 9): the mtime of every folder and size and mtime of
+# every file. Adding, removing or renaming a file changes the mtime of its folder, so a later run only has to
+# list the folders whose mtime differs and checks all others with a single stat.
+# Stored as SQLite database in the state folder, paths are relative to the library folder. Moves of the other
+# modes re-key the moved files, so they are not taken for new files afterwards.
+class TreeSnapshot(object):
+
+    filename = "tree_snapshot.sqlite"
+
+    def __init__(self, library_path, state_path):
+        self.root = str(library_path)
+        self.library_path = os.path.abspath(library_path)
+        self.db_path = os.path.join(state_path, self.filename)
+        self.connection = None
+
+    def exists(self):
+        return os.path.isfile(self.db_path)
+
+    def connect(self, create=True):
+        if self.connection is None:
+            if not create and not self.exists():
+                return None
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (dir TEXT, name TEXT, size INTEGER, "
+                                    "mtime_ns INTEGER, PRIMARY KEY (dir, name))")
+        return self.connection
+
+    def relativePath(self, path):
+        rel_path = os.path.relpath(os.path.abspath(path), self.library_path)
+        return None if rel_path.startswith(os.pardir) else rel_path
+
+    def absolutePath(self, rel_path):
+        return self.root if rel_path == os.curdir else os.path.join(self.root, rel_path)
+
+    # mtime of a folder, None if it does not exist anymore
+    @staticmethod
+    def statMtime(dir_path):
+        try:
+            return os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return None
+
+    # records all files and folders of a complete inventory of the library
+    def create(self, inventory):
+        connection = self.connect()
+        connection.execute("DELETE FROM dirs")
+        connection.execute("DELETE FROM files")
+        for dir_path in inventory.files_by_dir:
+            self.storeDirMtime(dir_path, self.statMtime(dir_path))
+        connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                               ((self.relativePath(record.dir), record.name, record.size, record.mtime_ns)
+                                for record in inventory))
+        self.commit()
+
+    # {dir_path: mtime_ns} of all recorded folders
+    def dirs(self):
+        rows = self.connect().execute("SELECT path, mtime_ns FROM dirs")
+        return {self.absolutePath(rel_path): mtime_ns for rel_path, mtime_ns in rows}
+
+    # {name: (size, mtime_ns)} of the recorded files of a folder
+    def filesIn(self, dir_path):
+        rows = self.connect().execute("SELECT name, size, mtime_ns FROM files WHERE dir = ?",
+                                      (self.relativePath(dir_path),))
+        return {name: (size, mtime_ns) for name, size, mtime_ns in rows}
+
+    # replaces the recorded files of a folder, a mtime_ns of None makes the folder count as changed
+    def storeDir(self, dir_path, mtime_ns, records):
+        rel_path = self.relativePath(dir_path)
+        connection = self.connect()
+        connection.execute("DELETE FROM files WHERE dir = ?", (rel_path,))
+        connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                               ((rel_path, record.name, record.size, record.mtime_ns) for record in records))
+        self.storeDirMtime(dir_path, mtime_ns)
+
+    def storeDirMtime(self, dir_path, mtime_ns):
+        self.connect().execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (self.relativePath(dir_path), mtime_ns))
+
+    def removeDir(self, dir_path):
+        rel_path = self.relativePath(dir_path)
+        self.connect().execute("DELETE FROM dirs WHERE path = ?", (rel_path,))
+        self.connect().execute("DELETE FROM files WHERE dir = ?", (rel_path,))
+
+    def move(self, src, dst):
+        connection = self.connect(create=False)
+        src_dir = self.relativePath(os.path.dirname(src))
+        if connection is None or src_dir is None:
+            return
+        dst_dir = self.relativePath(os.path.dirname(dst))
+        if dst_dir is None:
+            connection.execute("DELETE FROM files WHERE dir = ? AND name = ?", (src_dir, os.path.basename(src)))
+        else:
+            connection.execute("UPDATE OR REPLACE files SET dir = ?, name = ? WHERE dir = ? AND name = ?",
+                               (dst_dir, os.path.basename(dst), src_dir, os.path.basename(src)))
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def rollback(self):
+        if self.connection is not None:
+            self.connection.rollback()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+###############################################################################################################
+# Moves planned by one of the moving modes, all paths are absolute or relative to the working directory
+class MovePlan(object):
+
+    def __init__(self, moves=None, rmdirs=None):
+        self.moves = moves if moves is not None else []      # [(src, dst)] in execution order
+        self.rmdirs = rmdirs if rmdirs is not None else []   # folders removed after the moves if empty
+
+    def add(self, src, dst):
+        self.moves.append((str(src), str(dst)))
+
+
+# Names of the files (and folders) in one folder, plus the names claimed by planned moves into it.
+# Free "__NNN" suffixes are handed out from a counter per base name, so a clash costs no stat calls.
+class NameAllocator(object):
+
+    def __init__(self, names):
+        self.taken = {os.path.normcase(name) for name in names}
+        self.next_suffix = {}  # {(stem, ext): first suffix number that might be free}
+
+    @classmethod
+    def fromFolder(cls, folder_path):
+        return cls(os.listdir(folder_path))
+
+    def isFree(self, name):
+        return os.path.normcase(name) not in self.taken
+
+    # claims the name if it is free, returns False otherwise
+    def claim(self, name):
+        if not self.isFree(name):
+            return False
+        self.taken.add(os.path.normcase(name))
+        return True
+
+    # claims the name or, if it is taken, the first free name with a renaming suffix (name__001.ext, ...)
+    def claimFreeName(self, name):
+        if self.claim(name):
+            return name
+        stem, ext = os.path.splitext(name)
+        num = self.next_suffix.get((stem, ext), 1)
+        while not self.isFree(stem + "__" + f"{num:03}" + ext):
+            num += 1
+        self.next_suffix[(stem, ext)] = num + 1
+        renamed = stem + "__" + f"{num:03}" + ext
+        self.claim(renamed)
+        return renamed
+
+    # the name is free again, e.g. because the file is moved away by the plan
+    def release(self, name):
+        self.taken.discard(os.path.normcase(name))
+
+
+# State of one run as read back from the move journal
+class JournalRun(object):
+
+    def __init__(self, run_id, mode, plan, undo_of):
+        self.run_id = run_id
+        self.mode = mode
+        self.plan = plan
+        self.undo_of = undo_of
+        self.moved = []    # indexes of finished moves
+        self.mkdirs = []   # folders created by the run
+        self.ended = False
+
+
+###############################################################################################################
+# Append-only journal of executed move plans, stored as JSON lines in the state folder.
+# A run starts with a "begin" line containing the whole plan, followed by one line per finished move,
+# created or removed folder, and an "end" line. Paths are stored relative to the library folder.
+# When a run ends, the runs that are not needed anymore are dropped, so reading the journal at the start of
+# every moving mode does not get slower with each run.
+class MoveJournal(object):
+
+    filename = "move_journal.jsonl"
+    # number of runs that can be undone one after the other, older ones are dropped from the journal
+    max_undoable_runs = 20
+
+    def __init__(self, library_path, state_path):
+        self.library_path = str(library_path)
+        self.journal_path = os.path.join(state_path, self.filename)
+        self.file = None
+
+    def relativePath(self, path):
+        return os.path.relpath(path, self.library_path)
+
+    def absolutePath(self, rel_path):
+        return os.path.normpath(os.path.join(self.library_path, rel_path))
+
+    def begin(self, mode, plan, undo_of=None):
+        run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.write({"run": run_id, "op": "begin", "mode": mode, "undo_of": undo_of,
+                    "moves": [[self.relativePath(src), self.relativePath(dst)] for src, dst in plan.moves],
+                    "rmdirs": [self.relativePath(folder) for folder in plan.rmdirs]})
+        return run_id
+
+    def log(self, run_id, op, index=None, path=None):
+        entry = {"run": run_id, "op": op}
+        if index is not None:
+            entry["index"] = index
+        if path is not None:
+            entry["path"] = self.relativePath(path)
+        self.write(entry)
+
+    def end(self, run_id):
+        self.write({"run": run_id, "op": "end"})
+        os.fsync(self.file.fileno())
+        self.compact()
+
+    def write(self, entry):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # rewrites the journal without undone runs (together with their finished undo) and without the undoable
+    # runs beyond the last max_undoable_runs. The lines of the remaining runs are kept as they are.
+    def compact(self):
+        self.close()
+        lines = collections.OrderedDict()   # {run_id: [line]}
+        undo_of = {}
+        ended = set()
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # line cut off by a crash
+                if entry["op"] == "begin":
+                    lines[entry["run"]] = []
+                    undo_of[entry["run"]] = entry["undo_of"]
+                elif entry["run"] not in lines:
+                    continue
+                elif entry["op"] == "end":
+                    ended.add(entry["run"])
+                lines[entry["run"]].append(line)
+
+        dropped = set()
+        for run_id in ended:
+            if undo_of[run_id] is not None:
+                dropped.update((run_id, undo_of[run_id]))
+        undoable = [run_id for run_id in lines if undo_of[run_id] is None and run_id not in dropped]
+        dropped.update(undoable[:-self.max_undoable_runs])
+        if not dropped:
+            return
+
+        compacted_path = self.journal_path + ".tmp"
+        with open(compacted_path, 'w', encoding='utf-8') as f:
+            for run_id, run_lines in lines.items():
+                if run_id not in dropped:
+                    f.writelines(run_lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted_path, self.journal_path)
+
+    # all runs in the order they were started
+    def readRuns(self):
+        runs = collections.OrderedDict()
+        if not os.path.isfile(self.journal_path):
+            return []
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # line cut off by a crash
+                op = entry["op"]
+                if op == "begin":
+                    plan = MovePlan([(self.absolutePath(src), self.absolutePath(dst)) for src, dst in entry["moves"]],
+                                    [self.absolutePath(folder) for folder in entry["rmdirs"]])
+                    runs[entry["run"]] = JournalRun(entry["run"], entry["mode"], plan, entry["undo_of"])
+                    continue
+                run = runs.get(entry["run"])
+                if run is None:
+                    continue
+                if op == "moved":
+                    run.moved.append(entry["index"])
+                elif op == "mkdir":
+                    run.mkdirs.append(self.absolutePath(entry["path"]))
+                elif op == "end":
+                    run.ended = True
+        return list(runs.values())
+
+    def lastRun(self):
+        runs = self.readRuns()
+        return runs[-1] if runs else None
+
+    # the latest run that is no undo itself and was not undone yet
+    def lastUndoableRun(self):
+        runs = self.readRuns()
+        undone = {run.undo_of for run in runs if run.undo_of is not None and run.ended}
+        for run in reversed(runs):
+            if run.undo_of is None and run.run_id not in undone:
+                return run
+        return None
+
+
+###############################################################################################################
+# Wall time per phase and counters of the expensive operations of a run, for --profile and --stats_json.
+# Phases may be nested (e.g. exiftool within metadata), each one sums up the time spent in it. A disabled
+# instance records nothing: count() returns immediately and phase() is an empty context.
+class RunStats(object):
+
+    counter_names = ["files_scanned", "stat_calls", "metadata_bytes_read", "subprocesses_started",
+                     "moves", "cross_device_copies", "files_deleted"]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = dict.fromkeys(self.counter_names, 0)
+        self.phases = {}   # {name: seconds}, in order of first use
+        self.lock = threading.Lock()   # counters are also updated from worker threads
+
+    def count(self, name, num=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += num
+
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timePhase(name)
+
+    @contextlib.contextmanager
+    def timePhase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def printReport(self):
+        print("-----------------------------")
+        for name, seconds in self.phases.items():
+            print(f"{name}: {seconds:.3f} s")
+        for name, value in self.counters.items():
+            print(f"{name}: {value}")
+
+    def writeJson(self, file_path, **run_info):
+        data = dict(run_info)
+        data["phases"] = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+        data["counters"] = dict(self.counters)
+        with open(file_path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+###############################################################################################################
+# BK-tree of integer hashes under the Hamming distance. Each child is stored under its distance to the parent,
+# so a search only has to descend into the children whose distance differs from the distance between the
+# searched hash and the parent by at most max_distance (triangle inequality).
+class BKTree(object):
+
+    def __init__(self):
+        self.root = None   # [hash, items, {distance: child node}]
+
+    @staticmethod
+    def distance(a, b):
+        return bin(a ^ b).count('1')
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = self.distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    # items of all hashes that differ from value in at most max_distance bits
+    def search(self, value, max_distance):
+        found = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = self.distance(value, node[0])
+            if distance <= max_distance:
+                found.extend(node[1])
+            pending.extend(child for child_distance, child in node[2].items()
+                           if abs(child_distance - distance) <= max_distance)
+        return found
+
+
 ###############################################################################################################
 # Call main() as starting point
 if __name__ == '__main__':